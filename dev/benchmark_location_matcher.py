@@ -0,0 +1,66 @@
+"""Benchmark the non-US location matcher against the regex it replaced.
+
+Builds a synthetic catalog of DMP-like "FullPath BrandName" strings, checks that both
+give identical results and prints the time each takes.
+
+    python dev/benchmark_location_matcher.py --rows 200000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+sys.path.append(str(project_root / 'src'))
+
+from config.locations import NON_US_LOCATIONS
+from location_matcher import LocationMatcher, build_pattern
+
+WORDS = ["Auto", "Intenders", "In-Market", "Shoppers", "Luxury", "Travel", "Finance", "Sports", "Fans",
+         "Parents", "Pets", "Boston", "Texas", "Health", "B2B", "Demographics", "Age 25-34", "Income $100k+"]
+BRANDS = ["Acme Data", "Oracle", "Eyeota", "Experian", "Lotame"]
+
+
+def synthetic_catalog(rows, location_rate=0.2, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(rows):
+        path = [rng.choice(WORDS) for _ in range(rng.randint(2, 6))]
+        if rng.random() < location_rate:
+            path.insert(rng.randrange(len(path) + 1), rng.choice(NON_US_LOCATIONS))
+        texts.append(f"{' > '.join(path)} {rng.choice(BRANDS)}")
+    return texts
+
+
+def time_it(label, fn, texts):
+    started = time.perf_counter()
+    results = [fn(text) for text in texts]
+    elapsed = time.perf_counter() - started
+    print(f"{label}: {elapsed:.2f}s ({len(texts) / elapsed:,.0f} rows/sec)")
+    return results, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--location-rate', type=float, default=0.2)
+    args = parser.parse_args()
+
+    texts = synthetic_catalog(args.rows, args.location_rate)
+
+    started = time.perf_counter()
+    pattern = build_pattern(NON_US_LOCATIONS)
+    print(f"Regex compiled in {time.perf_counter() - started:.3f}s")
+    started = time.perf_counter()
+    matcher = LocationMatcher(NON_US_LOCATIONS)
+    print(f"Matcher built in {time.perf_counter() - started:.3f}s")
+
+    expected, regex_elapsed = time_it("regex", lambda text: pattern.search(text) is not None, texts)
+    actual, matcher_elapsed = time_it("matcher", matcher.search, texts)
+
+    mismatches = sum(a != b for a, b in zip(expected, actual))
+    print(f"{sum(expected)} of {len(texts)} rows matched, {mismatches} mismatches, "
+          f"{regex_elapsed / matcher_elapsed:.1f}x faster")
+    sys.exit(1 if mismatches else 0)
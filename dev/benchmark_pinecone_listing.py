@@ -0,0 +1,81 @@
+"""Check and time Pinecone id enumeration against an in-memory index stand-in.
+
+Builds a large sorted id space, serves it through list_paginated with a simulated
+per-call latency, and checks that the ids found missing locally are exactly the
+index's extra ids, optionally including ids whose prefixes no local id shares.
+
+    python dev/benchmark_pinecone_listing.py --vectors 1000000 --latency 0.002
+"""
+import argparse
+import bisect
+import random
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root / 'src'))
+
+from detect_pinecone_changes import iter_all_pinecone_ids
+
+
+class InMemoryIndex:
+    """The parts of a Pinecone index that id enumeration uses."""
+
+    def __init__(self, ids, latency=0.0):
+        self.ids = sorted(ids)
+        self.latency = latency
+        self.calls = 0
+
+    def describe_index_stats(self):
+        return {'total_vector_count': len(self.ids)}
+
+    def list_paginated(self, prefix=None, limit=100, pagination_token=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        start = int(pagination_token) if pagination_token else bisect.bisect_left(self.ids, prefix or '')
+        page = []
+        for position in range(start, min(start + limit, len(self.ids))):
+            if prefix and not self.ids[position].startswith(prefix):
+                break
+            page.append(self.ids[position])
+        position = start + len(page)
+        more = len(page) == limit and position < len(self.ids) and (not prefix or self.ids[position].startswith(prefix))
+        return SimpleNamespace(vectors=[SimpleNamespace(id=id) for id in page],
+                               pagination=SimpleNamespace(next=str(position)) if more else None)
+
+
+def time_it(label, local_ids, index, workers):
+    index.calls = 0
+    started = time.perf_counter()
+    extra = {id for id in iter_all_pinecone_ids(local_ids, index, workers) if id not in local_ids}
+    elapsed = time.perf_counter() - started
+    print(f"{label}: {elapsed:.2f}s, {index.calls} list calls")
+    return extra, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=1000000)
+    parser.add_argument('--latency', type=float, default=0.002, help="Seconds per list call")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--unknown-prefix-ids', type=int, default=0,
+                        help="Extra index ids with a prefix no local id has; these need the full listing fallback")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    remote = {str(rng.randrange(10 ** 9)) for _ in range(args.vectors)}
+    local = set(rng.sample(sorted(remote), int(len(remote) * 0.99)))
+    unshared = {f"x{n}" for n in range(args.unknown_prefix_ids)}
+    local.update(str(10 ** 9 + n) for n in range(1000))  # Local only, not yet upserted
+    index = InMemoryIndex(remote | unshared, args.latency)
+    expected = (remote | unshared) - local
+
+    serial, serial_elapsed = time_it("1 worker", local, index, 1)
+    concurrent, concurrent_elapsed = time_it(f"{args.workers} workers", local, index, args.workers)
+
+    ok = serial == expected and concurrent == expected
+    print(f"{len(index.ids)} vectors, {len(expected)} not in local ids, "
+          f"{'results match' if ok else 'MISMATCH'}, {serial_elapsed / concurrent_elapsed:.1f}x faster")
+    sys.exit(0 if ok else 1)
@@ -1,10 +1,12 @@
-import json
 import os
 import csv
+import sqlite3
 from dotenv import load_dotenv
 from openai import OpenAI
 from pinecone import Pinecone
 from tqdm import tqdm
+from pinecone_jsonl import load_records
+from pinecone_state import ensure_state_table, record_deletes, record_upserts
 
 # Load environment variables and initialize clients
 load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
@@ -14,17 +16,10 @@ index = pc.Index("3rd-party-data-v3")
 
 EMBEDDING_MODEL = "text-embedding-3-large"
 BATCH_SIZE = 200
+DB_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db"
 JSONL_FILE_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/jsonl/pinecone_data.jsonl"
 CSV_FILE_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/pinecone_changes_needed.csv"
 
-def load_local_data(file_path):
-    local_data = {}
-    with open(file_path, 'r') as file:
-        for line in file:
-            data = json.loads(line)
-            local_data[data['ThirdPartyDataId']] = data
-    return local_data
-
 def load_changes_from_csv(file_path):
     changes = {}
     with open(file_path, 'r') as csvfile:
@@ -53,8 +48,50 @@ def generate_embeddings(batch):
     )
     return [data.embedding for data in response.data]
 
-def apply_changes(local_data, changes, batch_size, limit):
+def upsert_with_embeddings(batch):
+    chunks = [create_chunk(item) for item in batch]
+    embeddings = generate_embeddings(batch)
+
+    upserts = [
+        {
+            "id": chunk['id'],
+            "values": embedding,
+            "metadata": chunk['metadata']
+        }
+        for chunk, embedding in zip(chunks, embeddings)
+    ]
+
+    index.upsert(upserts)
+
+def upsert_metadata_only(batch):
+    """Rewrite metadata while keeping the stored vectors, so nothing is re-embedded.
+
+    This replaces the whole metadata, unlike index.update(set_metadata=...) which merges
+    and would leave keys behind (e.g. a vertical's metrics that no longer apply). Records
+    whose vector is gone are embedded again.
+    """
+    chunks = [create_chunk(item) for item in batch]
+    stored = index.fetch(ids=[chunk['id'] for chunk in chunks])['vectors']
+
+    upserts = [
+        {
+            "id": chunk['id'],
+            "values": stored[chunk['id']]['values'],
+            "metadata": chunk['metadata']
+        }
+        for chunk in chunks if chunk['id'] in stored
+    ]
+    if upserts:
+        index.upsert(upserts)
+
+    missing = [item for item, chunk in zip(batch, chunks) if chunk['id'] not in stored]
+    if missing:
+        upsert_with_embeddings(missing)
+
+def apply_changes(local_data, changes, conn, batch_size, limit):
+    """Apply the changes batch by batch, recording each applied batch in the local Pinecone state."""
     upsert_batch = []
+    metadata_batch = []
     delete_ids = []
     processed_count = 0
 
@@ -63,34 +100,32 @@ def apply_changes(local_data, changes, batch_size, limit):
             break
         if action in ["add", "update"] and id in local_data:
             upsert_batch.append(local_data[id])
+        elif action == "update_metadata" and id in local_data:
+            metadata_batch.append(local_data[id])
         elif action == "delete":
             delete_ids.append(id)
         processed_count += 1
 
-    print(f"Processing {len(upsert_batch)} upserts and {len(delete_ids)} deletions")
+    print(f"Processing {len(upsert_batch)} upserts, {len(metadata_batch)} metadata updates and {len(delete_ids)} deletions")
 
     # Process upserts
     for i in tqdm(range(0, len(upsert_batch), batch_size), desc="Applying upserts"):
         current_batch = upsert_batch[i:i+batch_size]
-        chunks = [create_chunk(item) for item in current_batch]
-        embeddings = generate_embeddings(current_batch)
-        
-        upserts = [
-            {
-                "id": chunk['id'],
-                "values": embedding,
-                "metadata": chunk['metadata']
-            }
-            for chunk, embedding in zip(chunks, embeddings)
-        ]
-        
-        index.upsert(upserts)
+        upsert_with_embeddings(current_batch)
+        record_upserts(conn, [(item['ThirdPartyDataId'], item) for item in current_batch])
+
+    # Process metadata-only updates
+    for i in tqdm(range(0, len(metadata_batch), batch_size), desc="Applying metadata updates"):
+        current_batch = metadata_batch[i:i+batch_size]
+        upsert_metadata_only(current_batch)
+        record_upserts(conn, [(item['ThirdPartyDataId'], item) for item in current_batch])
 
     # Process deletions
     for i in tqdm(range(0, len(delete_ids), batch_size), desc="Applying deletions"):
         batch = delete_ids[i:i+batch_size]
         response = index.delete(ids=batch)
         print(response)
+        record_deletes(conn, batch)
 
 def print_sample_changed_records(changes, sample_size):
     print(f"\nSample of {sample_size} changed records:")
@@ -109,14 +144,19 @@ def print_sample_changed_records(changes, sample_size):
 
 # In the main function, call apply_changes with a limit:
 def main():
-    local_data = load_local_data(JSONL_FILE_PATH)
-    print(f"Loaded {len(local_data)} items from local JSONL file")
-
     changes = load_changes_from_csv(CSV_FILE_PATH)
     print(f"Loaded {len(changes)} changes from CSV file")
 
+    # Only the records being written are needed, so only their shards are read
+    local_data = load_records(JSONL_FILE_PATH, ids=[id for id, action in changes.items() if action != "delete"])
+    print(f"Loaded {len(local_data)} items from local JSONL file")
+
+    conn = sqlite3.connect(DB_PATH)
+    ensure_state_table(conn)
+
     # Set a limit for testing, e.g., 100 records
-    apply_changes(local_data, changes, batch_size=BATCH_SIZE, limit=None)
+    apply_changes(local_data, changes, conn, batch_size=BATCH_SIZE, limit=None)
+    conn.close()
     print("Changes applied to Pinecone database")
     print_sample_changed_records(changes, 10)
 
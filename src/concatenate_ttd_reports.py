@@ -3,18 +3,50 @@ import pandas as pd
 import sqlite3
 from datetime import datetime, timedelta
 import glob
+import json
+import hashlib
+import time
 
-def get_recent_csv_files(folder_path, months=6):
-    """Get the most recent 6 months of CSV files."""
+LEDGER_TABLE = 'report_stack_files'
+STATE_TABLE = 'report_stack_state'
+MANIFEST_PATH = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/ai_element_performance_manifest.json'
+COLUMNAR_DIR = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/parquet/ai_element_performance/'
+
+# Declared types for the report columns the pipeline uses, so nothing is inferred per file
+REPORT_DTYPES = {
+    'Advertiser': 'string',
+    '3rd Party Data ID': 'Int64',
+    '3rd Party Data Brand ID': 'string',
+    'Hypothetical Advertiser Cost (USD)': 'float64',
+    'Clicks': 'Int64',
+    'Impressions': 'Int64',
+    '01 - Total Click + View Conversions': 'float64',
+}
+# Columns report_stack and performance_summary need from each report. report_stack keeps
+# only these; every column stays in the Parquet archive.
+REPORT_STACK_COLUMNS = list(REPORT_DTYPES)
+# Parquet metadata key holding the sha256 of the CSV a report was converted from
+SOURCE_HASH_KEY = b'source_sha256'
+
+SQLITE_TYPES = {'string': 'TEXT', 'Int64': 'INTEGER', 'float64': 'REAL'}
+SUMMARY_TABLE = 'performance_summary'
+SUMMARY_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql_queries', 'performance_summary_vw.sql')
+THIRD_PARTY_DATA_ID_EXPR = '''CAST("3rd Party Data ID" AS INTEGER) || '|' || "3rd Party Data Brand ID"'''
+# Upper bound on memory used by one loaded chunk
+LOADER_MEMORY_LIMIT_MB = int(os.getenv('LOADER_MEMORY_LIMIT_MB', 256))
+
+def get_recent_report_files(folder_path, months=6, columnar_dir=COLUMNAR_DIR):
+    """Get the most recent 6 months of reports, as CSV files not yet archived or Parquet files."""
     today = datetime.now()
     six_months_ago = today - timedelta(days=30*months)
-    
-    csv_files = glob.glob(os.path.join(folder_path, 'ai_element_performance_*.csv'))
-    recent_files = [
-        file for file in csv_files
-        if datetime.strptime(os.path.basename(file).split('_')[3].split('.')[0], '%Y-%m-%d') >= six_months_ago
-    ]
-    
+
+    reports = {}
+    for file in glob.glob(os.path.join(columnar_dir, 'ai_element_performance_*.parquet')):
+        reports[get_report_name(file)] = file
+    for file in glob.glob(os.path.join(folder_path, 'ai_element_performance_*.csv')):
+        reports[get_report_name(file)] = file  # Not archived yet (e.g. pyarrow missing)
+    recent_files = [file for file in reports.values() if get_report_date(file) >= six_months_ago]
+
     return sorted(recent_files, reverse=True)
 
 def get_vertical_lookup(conn):
@@ -22,36 +54,377 @@ def get_vertical_lookup(conn):
     df = pd.read_sql_query("SELECT Advertiser, Vertical FROM advertiser_vertical_lookup", conn)
     return dict(zip(df.Advertiser, df.Vertical))
 
-def process_csv_files(file_list, db_path, table_name):
-    """Process CSV files and refresh the report_stack table with the last 6 months of data."""
+def get_report_date(file_path):
+    """Report date encoded in an ai_element_performance_<date>[_from_<start>].csv file name."""
+    return datetime.strptime(os.path.basename(file_path).split('_')[3].split('.')[0], '%Y-%m-%d')
+
+def get_report_name(file_path):
+    """The CSV file name a report was downloaded as, also for its Parquet copy."""
+    return os.path.splitext(os.path.basename(file_path))[0] + '.csv'
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_report_ranges(manifest_path):
+    """Map report file names to their (start, end) dates using the download manifest."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    return {
+        entry['File']: (entry['ReportStartDateInclusive'].split('T')[0], entry['ReportEndDateExclusive'].split('T')[0])
+        for entry in manifest.values()
+    }
+
+def get_report_hash(file_path):
+    """sha256 of the report's CSV, read from the Parquet metadata once the CSV is archived."""
+    if file_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        metadata = pq.read_schema(file_path).metadata or {}
+        if SOURCE_HASH_KEY in metadata:
+            return metadata[SOURCE_HASH_KEY].decode()
+    return hash_file(file_path)
+
+def describe_files(file_list, report_ranges):
+    """Name, hash and covered date range for each report file."""
+    files = []
+    for file in file_list:
+        name = get_report_name(file)
+        report_date = get_report_date(file).strftime('%Y-%m-%d')
+        # Without a manifest entry use the start date in the name, or assume a daily report
+        stem = os.path.splitext(name)[0]
+        if '_from_' in stem:
+            default_start = stem.rsplit('_from_', 1)[1]
+        else:
+            default_start = (get_report_date(file) - timedelta(days=1)).strftime('%Y-%m-%d')
+        start, end = report_ranges.get(name, (default_start, report_date))
+        files.append({"path": file, "ReportFile": name, "FileHash": get_report_hash(file),
+                      "ReportDate": report_date, "RangeStart": start, "RangeEnd": end})
+    return files
+
+def ensure_ledger(conn):
+    """Create the ingestion ledger. Returns False if report_stack must be rebuilt from scratch."""
+    exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (LEDGER_TABLE,)).fetchone()
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+            ReportFile TEXT PRIMARY KEY,
+            FileHash TEXT NOT NULL,
+            ReportDate TEXT NOT NULL,
+            RangeStart TEXT NOT NULL,
+            RangeEnd TEXT NOT NULL,
+            RowCount INTEGER NOT NULL,
+            LoadedUTC TEXT NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} (Key TEXT PRIMARY KEY, Value TEXT)")
+    return exists is not None
+
+def plan_ingestion(files, loaded):
+    """Decide which files to load and which loaded files to unload.
+
+    `loaded` maps ReportFile to its ledger row. Files already loaded with the same hash are
+    skipped. Overlapping report date ranges are deduplicated: an identical range is replaced
+    by the newer file, a range contained in a loaded one is skipped, and a range containing
+    loaded ones replaces them.
+    """
+    active = dict(loaded)
+    to_load, to_unload = {}, []
+    active_hashes = {row['FileHash'] for row in active.values()}
+
+    def drop(name):
+        active_hashes.discard(active.pop(name)['FileHash'])
+        if name in to_load:
+            del to_load[name]
+        else:
+            to_unload.append(name)
+
+    for file in sorted(files, key=lambda f: (f['ReportDate'], f['ReportFile'])):
+        current = active.get(file['ReportFile'])
+        if current and current['FileHash'] == file['FileHash']:
+            continue
+        if current:
+            # Same file name, new content: reload it
+            drop(file['ReportFile'])
+        elif file['FileHash'] in active_hashes:
+            print(f"Skipping {file['ReportFile']}: identical content already loaded")
+            continue
+
+        covered_by = None
+        for name, row in list(active.items()):
+            same = row['RangeStart'] == file['RangeStart'] and row['RangeEnd'] == file['RangeEnd']
+            contains_new = row['RangeStart'] <= file['RangeStart'] and file['RangeEnd'] <= row['RangeEnd']
+            contained_by_new = file['RangeStart'] <= row['RangeStart'] and row['RangeEnd'] <= file['RangeEnd']
+            if same or contained_by_new:
+                print(f"{file['ReportFile']} replaces overlapping report {name}")
+                drop(name)
+            elif contains_new:
+                covered_by = name
+                break
+            elif row['RangeStart'] < file['RangeEnd'] and file['RangeStart'] < row['RangeEnd']:
+                print(f"Warning: {file['ReportFile']} partially overlaps {name}, loading both")
+        if covered_by:
+            print(f"Skipping {file['ReportFile']}: date range already covered by {covered_by}")
+            continue
+
+        to_load[file['ReportFile']] = file
+        active[file['ReportFile']] = file
+        active_hashes.add(file['FileHash'])
+
+    return list(to_load.values()), to_unload
+
+def refresh_verticals(conn, table_name, vertical_lookup):
+    """Re-map Vertical on existing rows when the advertiser lookup has changed."""
+    lookup_hash = hashlib.sha256(json.dumps(sorted(vertical_lookup.items(), key=str), default=str).encode()).hexdigest()
+    row = conn.execute(f"SELECT Value FROM {STATE_TABLE} WHERE Key = 'vertical_lookup_hash'").fetchone()
+    if row and row[0] == lookup_hash:
+        return False
+    conn.execute(f"""
+        UPDATE "{table_name}" SET Vertical = (
+            SELECT l.Vertical FROM advertiser_vertical_lookup l WHERE l.Advertiser = "{table_name}".Advertiser
+        )
+    """)
+    conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE} (Key, Value) VALUES ('vertical_lookup_hash', ?)", (lookup_hash,))
+    return True
+
+def get_columnar_path(csv_path, columnar_dir=COLUMNAR_DIR):
+    return os.path.join(columnar_dir, os.path.splitext(os.path.basename(csv_path))[0] + '.parquet')
+
+def convert_to_columnar(csv_path, columnar_dir=COLUMNAR_DIR, memory_limit_mb=LOADER_MEMORY_LIMIT_MB):
+    """Archive a report CSV as a typed, zstd-compressed Parquet file and delete the CSV.
+
+    The CSV is streamed in chunks sized to stay under `memory_limit_mb` and written to
+    Parquet chunk by chunk. Columns outside REPORT_DTYPES are kept as text so every chunk
+    has the same schema. The CSV's hash goes into the Parquet metadata so the ingestion
+    ledger still recognizes the report. The CSV is only deleted once the Parquet file
+    reads back with the same rows and columns. Returns the Parquet path, or None if
+    pyarrow is not installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    parquet_path = get_columnar_path(csv_path, columnar_dir)
+    os.makedirs(columnar_dir, exist_ok=True)
+    header = list(pd.read_csv(csv_path, nrows=0).columns)
+    dtypes = {col: REPORT_DTYPES.get(col, 'string') for col in header}
+    chunk_rows = estimate_chunk_rows(csv_path, memory_limit_mb, columns=None)
+    tmp_path = f"{parquet_path}.tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in pd.read_csv(csv_path, dtype=dtypes, chunksize=chunk_rows):
+            if writer is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                schema = schema.with_metadata({**(schema.metadata or {}), SOURCE_HASH_KEY: hash_file(csv_path).encode()})
+                writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    written = pq.ParquetFile(tmp_path) if writer is not None else None
+    if written is None or written.metadata.num_rows != rows or written.schema_arrow.names != header:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise ValueError(f"Parquet copy of {csv_path} does not match it, keeping the CSV")
+    os.replace(tmp_path, parquet_path)
+    os.remove(csv_path)
+    print(f"Archived {csv_path} as {parquet_path}")
+    return parquet_path
+
+def archive_csv_files(folder_path, columnar_dir=COLUMNAR_DIR, memory_limit_mb=LOADER_MEMORY_LIMIT_MB):
+    """Convert every downloaded report CSV to Parquet. Returns the number archived."""
+    archived = 0
+    for csv_path in sorted(glob.glob(os.path.join(folder_path, 'ai_element_performance_*.csv'))):
+        if convert_to_columnar(csv_path, columnar_dir, memory_limit_mb) is None:
+            print("pyarrow is not installed, keeping report CSVs")
+            break
+        archived += 1
+    return archived
+
+def iter_report_chunks(path, chunk_rows, columns=REPORT_STACK_COLUMNS):
+    """Yield a report, Parquet or not yet archived CSV, in DataFrames of at most `chunk_rows` rows."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas().astype(REPORT_DTYPES)
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=REPORT_DTYPES, chunksize=chunk_rows)
+
+def estimate_chunk_rows(csv_path, memory_limit_mb, sample_rows=1000, columns=REPORT_STACK_COLUMNS):
+    """Rows per chunk that keep one chunk of `columns` (None for all), plus its copy, under the memory limit."""
+    sample = next(iter_report_chunks(csv_path, sample_rows, columns), None)
+    if sample is None or sample.empty:
+        return sample_rows
+    # The object-dtype copy built for executemany roughly doubles the footprint
+    bytes_per_row = 2 * sample.memory_usage(deep=True).sum() / len(sample)
+    return max(sample_rows, int(memory_limit_mb * 1024 * 1024 // bytes_per_row))
+
+def ensure_report_table(conn, table_name):
+    columns = [f'"{col}" {SQLITE_TYPES[dtype]}' for col, dtype in REPORT_DTYPES.items()]
+    columns += ['"Vertical" TEXT', '"ReportFile" TEXT', '"ReportDate" TEXT']
+    conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({", ".join(columns)})')
+
+def load_report_file(conn, table_name, file, vertical_lookup, memory_limit_mb=LOADER_MEMORY_LIMIT_MB):
+    """Stream one report into table_name in bounded chunks with executemany.
+
+    The caller owns the transaction. Returns the number of rows inserted.
+    """
+    columns = REPORT_STACK_COLUMNS + ['Vertical', 'ReportFile', 'ReportDate']
+    column_list = ', '.join(f'"{col}"' for col in columns)
+    insert_sql = f'INSERT INTO "{table_name}" ({column_list}) VALUES ({", ".join("?" for _ in columns)})'
+    vertical_series = pd.Series(vertical_lookup, dtype=object)
+    chunk_rows = estimate_chunk_rows(file['path'], memory_limit_mb)
+    total_rows = 0
+
+    for chunk in iter_report_chunks(file['path'], chunk_rows):
+        # Vectorized join against the advertiser lookup for the whole chunk
+        chunk['Vertical'] = chunk['Advertiser'].map(vertical_series)
+        chunk['ReportFile'] = file['ReportFile']
+        chunk['ReportDate'] = file['ReportDate']
+        chunk = chunk[columns].astype(object)
+        conn.executemany(insert_sql, chunk.where(chunk.notna(), None).itertuples(index=False, name=None))
+        total_rows += len(chunk)
+    return total_rows
+
+def ensure_summary_table(conn, table_name):
+    """Create performance_summary as a table, replacing the old view. Returns True if it was new.
+
+    Also indexes `table_name` on the summary key expression, which the key lookups use.
+    """
+    existing = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (SUMMARY_TABLE,)).fetchone()
+    if existing and existing[0] == 'view':
+        conn.execute(f"DROP VIEW {SUMMARY_TABLE}")
+    with open(SUMMARY_SCHEMA_PATH, 'r') as f:
+        for statement in f.read().split(';'):
+            if statement.strip() and not all(line.strip().startswith('--') for line in statement.strip().splitlines()):
+                conn.execute(statement)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_ThirdPartyDataId" ON "{table_name}" (({THIRD_PARTY_DATA_ID_EXPR}))')
+    return existing is None or existing[0] != 'table'
+
+def mark_touched_keys(conn, table_name, where, params=()):
+    """Remember the performance_summary keys of the report_stack rows matching `where`."""
+    conn.execute(f"""
+        INSERT OR IGNORE INTO temp.touched_keys (ThirdPartyDataId)
+        SELECT DISTINCT {THIRD_PARTY_DATA_ID_EXPR} FROM "{table_name}"
+        WHERE ({where}) AND {THIRD_PARTY_DATA_ID_EXPR} IS NOT NULL
+    """, params)
+
+def refresh_performance_summary(conn, table_name, full=False):
+    """Re-aggregate performance_summary, for every key or only the touched ones.
+
+    Rows with a blank 3rd party data or brand ID have no key and are left out.
+    """
+    select = f"""
+        SELECT
+            {THIRD_PARTY_DATA_ID_EXPR} AS ThirdPartyDataId,
+            "Vertical",
+            SUM("Hypothetical Advertiser Cost (USD)") AS total_hypothetical_cost,
+            SUM("Clicks") AS total_clicks,
+            SUM("Impressions") AS total_impressions,
+            SUM("01 - Total Click + View Conversions") AS total_click_view_conversions
+        FROM "{table_name}"
+    """
+    columns = "ThirdPartyDataId, Vertical, total_hypothetical_cost, total_clicks, total_impressions, total_click_view_conversions"
+    if full:
+        conn.execute(f"DELETE FROM {SUMMARY_TABLE}")
+        conn.execute(f"INSERT INTO {SUMMARY_TABLE} ({columns}) {select} WHERE {THIRD_PARTY_DATA_ID_EXPR} IS NOT NULL GROUP BY ThirdPartyDataId, Vertical")
+        return conn.execute(f"SELECT COUNT(*) FROM {SUMMARY_TABLE}").fetchone()[0]
+
+    conn.execute(f"DELETE FROM {SUMMARY_TABLE} WHERE ThirdPartyDataId IN (SELECT ThirdPartyDataId FROM temp.touched_keys)")
+    return conn.execute(f"""
+        INSERT INTO {SUMMARY_TABLE} ({columns}) {select}
+        WHERE {THIRD_PARTY_DATA_ID_EXPR} IN (SELECT ThirdPartyDataId FROM temp.touched_keys)
+        GROUP BY ThirdPartyDataId, Vertical
+    """).rowcount
+
+def process_csv_files(file_list, db_path, table_name, months=6, manifest_path=MANIFEST_PATH, memory_limit_mb=LOADER_MEMORY_LIMIT_MB):
+    """Incrementally maintain report_stack with the last 6 months of data.
+
+    Only report files not yet recorded in the ingestion ledger are read and appended;
+    rows whose report date has left the window are deleted. Files are streamed in chunks
+    sized to stay under `memory_limit_mb` and inserted in a single transaction.
+    """
     conn = sqlite3.connect(db_path)
     vertical_lookup = get_vertical_lookup(conn)
-    
-    # Create or replace the table with the first file
-    if file_list:
-        df = pd.read_csv(file_list[0])
-        df['Vertical'] = df['Advertiser'].map(vertical_lookup)
-        df.to_sql(table_name, conn, if_exists='replace', index=False)
-        print(f"Replaced {table_name} with data from {file_list[0]}")
-        
-        # Process the rest of the files
-        for file in file_list[1:]:
-            df = pd.read_csv(file)
-            df['Vertical'] = df['Advertiser'].map(vertical_lookup)
-            df.to_sql(table_name, conn, if_exists='append', index=False)
-            print(f"Added data from {file} to {table_name}")
-    
+    cutoff = (datetime.now() - timedelta(days=30*months)).isoformat()
+
+    if not ensure_ledger(conn):
+        # First incremental run: rows from the old full rebuild carry no ReportFile/ReportDate
+        conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        print(f"Rebuilding {table_name} with an ingestion ledger")
+
+    loaded = {row[0]: dict(zip(['ReportFile', 'FileHash', 'ReportDate', 'RangeStart', 'RangeEnd'], row))
+              for row in conn.execute(f"SELECT ReportFile, FileHash, ReportDate, RangeStart, RangeEnd FROM {LEDGER_TABLE}")}
+    files = describe_files(file_list, load_report_ranges(manifest_path))
+    to_load, to_unload = plan_ingestion(files, {name: row for name, row in loaded.items() if row['ReportDate'] >= cutoff})
+
+    table_exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()
+    ensure_report_table(conn, table_name)
+    full_summary_refresh = ensure_summary_table(conn, table_name)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched_keys (ThirdPartyDataId TEXT PRIMARY KEY)")
+    # Eviction, unloads, loads, ledger and summary updates commit together or not at all
+    if table_exists:
+        mark_touched_keys(conn, table_name, "ReportDate < ?", (cutoff,))
+        evicted = conn.execute(f'DELETE FROM "{table_name}" WHERE ReportDate < ?', (cutoff,)).rowcount
+        conn.execute(f"DELETE FROM {LEDGER_TABLE} WHERE ReportDate < ?", (cutoff,))
+        print(f"Evicted {evicted} rows with report dates before {cutoff}")
+        for name in to_unload:
+            mark_touched_keys(conn, table_name, "ReportFile = ?", (name,))
+            removed = conn.execute(f'DELETE FROM "{table_name}" WHERE ReportFile = ?', (name,)).rowcount
+            conn.execute(f"DELETE FROM {LEDGER_TABLE} WHERE ReportFile = ?", (name,))
+            print(f"Unloaded {removed} rows from {name}")
+
+    load_started = time.perf_counter()
+    loaded_rows = 0
+    for file in to_load:
+        started = time.perf_counter()
+        row_count = load_report_file(conn, table_name, file, vertical_lookup, memory_limit_mb)
+        mark_touched_keys(conn, table_name, "ReportFile = ?", (file['ReportFile'],))
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {LEDGER_TABLE} (ReportFile, FileHash, ReportDate, RangeStart, RangeEnd, RowCount, LoadedUTC)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (file['ReportFile'], file['FileHash'], file['ReportDate'], file['RangeStart'], file['RangeEnd'],
+              row_count, datetime.utcnow().isoformat()))
+        elapsed = time.perf_counter() - started
+        loaded_rows += row_count
+        print(f"Added {row_count} rows from {file['path']} to {table_name} ({row_count / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_ReportFile" ON "{table_name}" (ReportFile)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_ReportDate" ON "{table_name}" (ReportDate)')
+    if refresh_verticals(conn, table_name, vertical_lookup):
+        if table_exists:
+            print(f"Advertiser verticals changed, re-mapped Vertical in {table_name}")
+        full_summary_refresh = True
+
+    started = time.perf_counter()
+    summary_rows = refresh_performance_summary(conn, table_name, full=full_summary_refresh)
+    scope = "all keys" if full_summary_refresh else f"{conn.execute('SELECT COUNT(*) FROM temp.touched_keys').fetchone()[0]} touched keys"
+    print(f"Refreshed {summary_rows} {SUMMARY_TABLE} rows for {scope} in {time.perf_counter() - started:.1f}s")
+    conn.commit()
+
+    if loaded_rows:
+        elapsed = time.perf_counter() - load_started
+        print(f"Loaded {loaded_rows} rows in {elapsed:.1f}s ({loaded_rows / max(elapsed, 1e-9):,.0f} rows/sec)")
+    print(f"Loaded {len(to_load)} new report files, skipped {len(files) - len(to_load)} already loaded")
     conn.close()
 
-def remove_old_csv_files(folder_path, months=12):
-    """Remove CSV files older than 12 months."""
+def remove_old_csv_files(folder_path, months=12, columnar_dir=COLUMNAR_DIR):
+    """Remove CSV files and their columnar copies older than 12 months."""
     today = datetime.now()
     cutoff_date = today - timedelta(days=30*months)
     
     csv_files = glob.glob(os.path.join(folder_path, 'ai_element_performance_*.csv'))
+    columnar_files = glob.glob(os.path.join(columnar_dir, 'ai_element_performance_*.parquet'))
     removed_count = 0
     
-    for file in csv_files:
+    for file in csv_files + columnar_files:
         file_date = datetime.strptime(os.path.basename(file).split('_')[3].split('.')[0], '%Y-%m-%d')
         if file_date < cutoff_date:
             os.remove(file)
@@ -67,13 +440,16 @@ if __name__ == "__main__":
 
     # Remove old CSV files
     removed_files = remove_old_csv_files(input_folder)
-    print(f"Removed {removed_files} CSV files older than 12 months.")
+    print(f"Removed {removed_files} report files older than 12 months.")
+
+    archived_files = archive_csv_files(input_folder)
+    print(f"Archived {archived_files} report CSVs as Parquet.")
 
-    recent_files = get_recent_csv_files(input_folder)
-    print(f"Found {len(recent_files)} CSV files from the last 6 months.")
+    recent_files = get_recent_report_files(input_folder)
+    print(f"Found {len(recent_files)} report files from the last 6 months.")
 
     if recent_files:
         process_csv_files(recent_files, output_db, table_name)
         print(f"Report stack in {output_db} has been updated with the latest 6 months of data.")
     else:
-        print("No recent CSV files found.")
\ No newline at end of file
+        print("No recent report files found.")
\ No newline at end of file
@@ -1,118 +1,248 @@
-import json
 import os
 import csv
+import queue
+import random
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from pinecone import Pinecone
 from tqdm import tqdm
+from pinecone_jsonl import load_records
+from pinecone_state import (EMBEDDING_HASH_KEY, METADATA_HASH_KEY, diff_against_state, load_state,
+                            record_deletes, record_upserts)
 
 # Load environment variables and initialize clients
 load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
 pc = Pinecone(api_key=os.environ.get('PINECONE_API_KEY'))
 index = pc.Index("3rd-party-data-v3")
 
+DB_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db"
 JSONL_FILE_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/jsonl/pinecone_data.jsonl"
 OUTPUT_CSV_PATH = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/pinecone_changes_needed.csv"
 BATCH_SIZE = 200  # Adjust this based on your memory constraints
-
-def load_local_data(file_path):
-    local_data = {}
-    with open(file_path, 'r') as file:
-        for line in file:
-            data = json.loads(line)
-            local_data[data['ThirdPartyDataId']] = data
-    return local_data
+LIST_PAGE_SIZE = 100  # Most ids the list endpoint returns per page
+LIST_PREFIX_LENGTH = 2  # Ids are listed concurrently per prefix of this length
+LIST_WORKERS = 8
 
 def fetch_pinecone_data(id_list):
     return index.fetch(ids=id_list)
 
 def compare_data(local_item, pinecone_item):
+    """Return (action, different keys) for one record.
+
+    Records carry metadata_hash and embedding_hash (see prepare_pinecone_jsonl). A changed
+    embedding hash needs a re-embedding ("update"); a changed metadata hash alone only
+    needs the metadata rewritten ("update_metadata").
+    """
     if not pinecone_item:
         return "add", ["all"]  # Item doesn't exist in Pinecone, needs to be added
 
-    local_metadata = {k: str(v) for k, v in local_item.items() if k != 'ThirdPartyDataId'}
     pinecone_metadata = pinecone_item['metadata']
+    if EMBEDDING_HASH_KEY in pinecone_metadata:
+        if pinecone_metadata[EMBEDDING_HASH_KEY] != local_item[EMBEDDING_HASH_KEY]:
+            return "update", ["embedding"]
+        if pinecone_metadata.get(METADATA_HASH_KEY) != local_item[METADATA_HASH_KEY]:
+            return "update_metadata", ["metadata"]
+        return None, []  # No changes needed
 
-    different_keys = []
+    # Vectors written before the fingerprints existed: compare key by key. They always
+    # differ at least on the hash keys, so they get them on the next apply.
+    local_metadata = {k: str(v) for k, v in local_item.items() if k != 'ThirdPartyDataId'}
 
-    # Compare 'raw_string'
     local_raw_string = f"Full Path: {local_item['FullPath']}, Description: {local_item['Description']}"
     if local_raw_string != pinecone_metadata.get('raw_string', ''):
-        different_keys.append('raw_string')
-
-    # Compare other metadata fields
-    for key, value in local_metadata.items():
-        if key not in pinecone_metadata or str(pinecone_metadata[key]) != value:
-            different_keys.append(key)
+        return "update", ['raw_string']
 
+    different_keys = [key for key, value in local_metadata.items()
+                      if key not in pinecone_metadata or str(pinecone_metadata[key]) != value]
     if different_keys:
-        return "update", different_keys
+        return "update_metadata", different_keys
     return None, []  # No changes needed
 
-def find_and_write_changes(local_data, csv_writer, batch_size=BATCH_SIZE):
-    changes_count = 0
-    for i in tqdm(range(0, len(local_data), batch_size), desc="Comparing data"):
-        batch_ids = list(local_data.keys())[i:i+batch_size]
-        pinecone_batch = fetch_pinecone_data(batch_ids)
-        
-        batch_changes = []
+def remote_hashes(local_item, pinecone_item):
+    """The (metadata_hash, embedding_hash) that describe pinecone_item relative to local_item.
+
+    For vectors written before the fingerprints existed, this is worked out with
+    compare_data, so a local diff against it gives the same action as compare_data.
+    """
+    metadata = pinecone_item['metadata']
+    hashes = {METADATA_HASH_KEY: metadata.get(METADATA_HASH_KEY), EMBEDDING_HASH_KEY: metadata.get(EMBEDDING_HASH_KEY)}
+    if local_item is not None and EMBEDDING_HASH_KEY not in metadata:
+        action, _ = compare_data(local_item, pinecone_item)
+        if action != "update":  # The embedded text is current
+            hashes[EMBEDDING_HASH_KEY] = local_item[EMBEDDING_HASH_KEY]
+        if action is None:
+            hashes[METADATA_HASH_KEY] = local_item[METADATA_HASH_KEY]
+    return hashes
+
+def reconcile_state(local_data, conn, ids, batch_size=BATCH_SIZE):
+    """Fetch `ids` from Pinecone and correct the local state to what the index holds.
+
+    Returns how many of them the state had wrong.
+    """
+    state = load_state(conn)
+    drift = 0
+    for i in tqdm(range(0, len(ids), batch_size), desc="Reconciling with Pinecone"):
+        batch_ids = ids[i:i+batch_size]
+        pinecone_batch = fetch_pinecone_data(batch_ids)['vectors']
+
+        present = []
+        missing = []
         for id in batch_ids:
-            local_item = local_data[id]
-            pinecone_item = pinecone_batch['vectors'].get(id)
-            action, different_keys = compare_data(local_item, pinecone_item)
-            if action:
-                batch_changes.append((id, action, ','.join(different_keys)))
-                changes_count += 1
+            pinecone_item = pinecone_batch.get(id)
+            if not pinecone_item:
+                missing.append(id)
+                drift += id in state
+                continue
+            hashes = remote_hashes(local_data.get(id), pinecone_item)
+            present.append((id, hashes))
+            drift += state.get(id) != (hashes[METADATA_HASH_KEY], hashes[EMBEDDING_HASH_KEY])
+
+        record_upserts(conn, present)
+        record_deletes(conn, missing)
+
+    return drift
+
+def reconcile_deletions(local_data, conn, index=index):
+    """Scan the index's ids and make the state list every vector not in the local data."""
+    state = load_state(conn)
+    pending = {id for id in state if id not in local_data}  # The state expects these in the index
+    extra = []
+    listed = 0
+    for id in iter_all_pinecone_ids(local_data.keys() | state.keys(), index):
+        listed += 1
+        if id in local_data:
+            continue
+        if id in pending:
+            pending.discard(id)
+        elif id not in state:
+            extra.append((id, {}))
+    print(f"Found {listed} items in Pinecone")
+
+    record_upserts(conn, extra)
+    record_deletes(conn, pending)  # Listed in the state but no longer in the index
+    return len(extra) + len(pending)
+
+def list_prefixes(ids, length=LIST_PREFIX_LENGTH):
+    """Prefixes of `ids`, dropping any that another prefix already covers."""
+    prefixes = []
+    for prefix in sorted({id[:length] for id in ids}):
+        if not prefixes or not prefix.startswith(prefixes[-1]):
+            prefixes.append(prefix)
+    return prefixes
+
+def iter_pinecone_ids(prefixes, index=index, workers=LIST_WORKERS):
+    """Yield every id that starts with one of `prefixes`, listing the prefixes concurrently.
 
-        # Write batch changes to CSV
-        csv_writer.writerows(batch_changes)
-
-    return changes_count
-
-def get_all_pinecone_ids():
-    stats = index.describe_index_stats()
-    total_vectors = stats['total_vector_count']
-    
-    all_ids = set()
-    batch_size = 10000  # Adjust based on your Pinecone plan limits
-    
-    for i in tqdm(range(0, total_vectors, batch_size), desc="Fetching Pinecone IDs"):
-        results = index.query(
-            vector=[0] * 256,  # Dummy vector
-            top_k=batch_size,
-            include_metadata=False,
-            include_values=False
-        )
-        all_ids.update(match['id'] for match in results['matches'])
-    
-    return all_ids
+    Each prefix is paged through index.list_paginated in its own thread. Pages pass
+    through a bounded queue, so ids are consumed as they arrive and memory stays flat
+    however large the index is. An empty prefix lists the whole index.
+    """
+    pages = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    done = object()
+
+    def list_prefix(prefix):
+        try:
+            token = None
+            while not stop.is_set():
+                page = index.list_paginated(prefix=prefix or None, limit=LIST_PAGE_SIZE, pagination_token=token)
+                pages.put([vector.id for vector in page.vectors])
+                token = page.pagination.next if page.pagination else None
+                if not token:
+                    break
+        finally:
+            pages.put(done)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+        remaining = len(futures)
+        try:
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                else:
+                    yield from page
+        finally:
+            stop.set()
+            while remaining:  # Let workers blocked on a full queue finish
+                if pages.get() is done:
+                    remaining -= 1
+        for future in futures:
+            future.result()  # Re-raise a failed listing
+
+def iter_all_pinecone_ids(known_ids, index=index, workers=LIST_WORKERS):
+    """Yield every id in the index, listing by the prefixes of the ids we know of.
+
+    If that finds fewer vectors than the index reports, some ids have other prefixes,
+    so the whole index is listed once more, in a single page chain, for the ids the
+    prefixes did not cover.
+    """
+    prefixes = list_prefixes(known_ids) or ['']
+    total_vectors = index.describe_index_stats()['total_vector_count']
+
+    listed = 0
+    with tqdm(total=total_vectors, desc="Listing Pinecone IDs") as progress:
+        for id in iter_pinecone_ids(prefixes, index, workers):
+            listed += 1
+            progress.update()
+            yield id
+
+        if listed < total_vectors and prefixes != ['']:
+            print(f"Listed {listed} of {total_vectors} vectors by prefix, listing the rest")
+            covered = tuple(prefixes)
+            for id in iter_pinecone_ids([''], index, workers=1):
+                if not id.startswith(covered):
+                    progress.update()
+                    yield id
 
 def main():
-    # Clear existing CSV file
-    with open(OUTPUT_CSV_PATH, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['ID', 'Action', 'Different Keys'])
+    parser = argparse.ArgumentParser(description="Write the changes needed to bring Pinecone in line with pinecone_data.jsonl")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="Check every id against the Pinecone index and correct the local state first")
+    parser.add_argument('--reconcile-sample', type=int, metavar='N',
+                        help="Check a random sample of N ids against the Pinecone index first")
+    args = parser.parse_args()
 
-    local_data = load_local_data(JSONL_FILE_PATH)
+    local_data = load_records(JSONL_FILE_PATH)
     print(f"Loaded {len(local_data)} items from local JSONL file")
 
-    with open(OUTPUT_CSV_PATH, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        changes_count = find_and_write_changes(local_data, writer)
+    conn = sqlite3.connect(DB_PATH)
+    state = load_state(conn)
+    print(f"Loaded {len(state)} items from the local Pinecone state")
 
-    print(f"Found and wrote {changes_count} items that need changes in Pinecone")
+    if args.reconcile or not state:
+        if not state:
+            print("No local Pinecone state yet, reconciling against the index")
+        drift = reconcile_state(local_data, conn, list(local_data))
+        drift += reconcile_deletions(local_data, conn)
+        print(f"Reconciled every id, corrected {drift} state entries")
+    elif args.reconcile_sample:
+        sample = random.sample(list(local_data), min(args.reconcile_sample, len(local_data)))
+        drift = reconcile_state(local_data, conn, sample)
+        print(f"Reconciled a sample of {len(sample)} ids, corrected {drift} state entries"
+              + (" - consider a full --reconcile" if drift else ""))
 
-    pinecone_ids = get_all_pinecone_ids()
-    print(f"Found {len(pinecone_ids)} items in Pinecone")
+    state = load_state(conn)
+    conn.close()
 
-    # Add delete actions for items in Pinecone but not in local data
+    # Everything below is a local diff: no Pinecone calls
+    changes_count = 0
     delete_count = 0
-    with open(OUTPUT_CSV_PATH, 'a', newline='') as csvfile:
+    with open(OUTPUT_CSV_PATH, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
-        for id in tqdm(pinecone_ids, desc="Checking for deletions"):
-            if id not in local_data:
-                writer.writerow([id, "delete", "all"])
+        writer.writerow(['ID', 'Action', 'Different Keys'])
+        for id, action, different_keys in diff_against_state(local_data, state):
+            writer.writerow([id, action, ','.join(different_keys)])
+            if action == "delete":
                 delete_count += 1
+            else:
+                changes_count += 1
 
+    print(f"Found and wrote {changes_count} items that need changes in Pinecone")
     print(f"Added {delete_count} delete actions")
     print(f"Total changes to apply: {changes_count + delete_count}")
     print(f"All changes written to {OUTPUT_CSV_PATH}")
@@ -128,4 +258,4 @@ def main():
             print(f"ID: {row[0]}, Action: {row[1]}, Different Keys: {row[2]}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -9,11 +9,143 @@ project_root = Path(__file__).resolve().parents[1]
 sys.path.append(str(project_root))
 
 from config.locations import NON_US_LOCATIONS
+from location_matcher import get_location_matcher
 
 import json
-import re
+import gzip
+import hashlib
 import sqlite3
-from typing import List, Dict
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+INSERT_BATCH_SIZE = 5000
+# Worker processes for parsing and filtering, 1 runs everything in this process
+PARSE_WORKERS = int(os.getenv('DMP_PARSE_WORKERS', os.cpu_count() or 1))
+CHUNK_BYTES = 16 * 1024 * 1024
+LOCATION_MEMO_TABLE = 'fullpath_location_memo'
+EXPORT_BATCH_ROWS = 10000
+KEY_COLUMN = 'ThirdPartyDataId'
+CONTENT_HASH_COLUMN = '_content_hash'
+CHANGES_TABLE = 'segment_changes'
+CHANGES_RETENTION_DAYS = 30
+# ThirdPartyDataIds whose last staged content hash is kept in memory to drop exact repeats before staging
+DEDUP_SEEN_CAPACITY = int(os.getenv('DMP_DEDUP_SEEN_CAPACITY', 500000))
+EXPORT_FORMATS = ('csv', 'csv.gz', 'csv.zst', 'parquet')
+PATH_SEPARATOR = '>'
+
+
+class StageStats:
+    """Rows handled and time spent per pipeline stage, for rows/sec reporting."""
+
+    def __init__(self):
+        self.rows = {}
+        self.seconds = {}
+        self.counts = {}
+        self.filtered_out = 0
+
+    def add(self, stage: str, rows: int, seconds: float):
+        self.rows[stage] = self.rows.get(stage, 0) + rows
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other: 'StageStats'):
+        for stage, rows in other.rows.items():
+            self.add(stage, rows, other.seconds[stage])
+        for name, n in other.counts.items():
+            self.count(name, n)
+        self.filtered_out += other.filtered_out
+
+    def report(self):
+        for stage, rows in self.rows.items():
+            seconds = self.seconds[stage]
+            print(f"  {stage}: {rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):,.0f} rows/sec)")
+        for name, n in self.counts.items():
+            print(f"  {name}: {n}")
+
+
+class FullPathMemo:
+    """Non-US classification of FullPath prefixes, shared by every segment below them.
+
+    The search text is split into nodes on '>'. No location contains '>' and it is not a
+    word character, so a location matches the whole text exactly when it matches one
+    node on its own. Each distinct prefix is classified once and a non-US prefix marks
+    all of its descendants; only the last node, which carries the BrandName, is checked
+    for every segment. Prefixes are persisted per location list so unchanged taxonomy
+    branches are not re-scanned on later runs.
+    """
+
+    def __init__(self, locations: Iterable[str], known: Dict[str, bool] = None):
+        locations = list(locations)
+        self.matcher = get_location_matcher(locations)
+        self.key = locations_hash(locations)
+        self.splittable = not any(PATH_SEPARATOR in location for location in locations)
+        self.known = dict(known or {})
+        self.new = {}
+
+    def is_non_us(self, text: str, stats: StageStats) -> bool:
+        if not self.splittable:
+            return self.matcher.search(text)
+        start = 0
+        end = text.find(PATH_SEPARATOR)
+        while end != -1:
+            prefix = text[:end]
+            non_us = self.known.get(prefix)
+            if non_us is None:
+                non_us = self.matcher.search(text[start:end])
+                self.known[prefix] = self.new[prefix] = non_us
+                stats.count('prefixes classified')
+            else:
+                stats.count('prefixes reused')
+            if non_us:
+                return True  # Inherited from the ancestor
+            start = end + 1
+            end = text.find(PATH_SEPARATOR, start)
+        return self.matcher.search(text[start:])
+
+    def take_new(self) -> Dict[str, bool]:
+        """Return prefixes classified since the last call."""
+        new, self.new = self.new, {}
+        return new
+
+    def add(self, classified: Dict[str, bool]):
+        """Record prefixes classified elsewhere, e.g. in a worker process."""
+        for prefix, non_us in classified.items():
+            if prefix not in self.known:
+                self.known[prefix] = self.new[prefix] = non_us
+
+    @classmethod
+    def load(cls, conn, locations: Iterable[str]) -> 'FullPathMemo':
+        """Load the memo for `locations`, discarding entries made for other location lists."""
+        locations = list(locations)
+        key = locations_hash(locations)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {LOCATION_MEMO_TABLE} (
+                LocationsHash TEXT NOT NULL,
+                Prefix TEXT NOT NULL,
+                NonUS INTEGER NOT NULL,
+                PRIMARY KEY (LocationsHash, Prefix)
+            ) WITHOUT ROWID
+        """)
+        conn.execute(f"DELETE FROM {LOCATION_MEMO_TABLE} WHERE LocationsHash != ?", (key,))
+        known = {prefix: bool(non_us) for prefix, non_us in
+                 conn.execute(f"SELECT Prefix, NonUS FROM {LOCATION_MEMO_TABLE} WHERE LocationsHash = ?", (key,))}
+        return cls(locations, known)
+
+    def save(self, conn) -> int:
+        """Persist newly classified prefixes and return how many were written."""
+        new = self.take_new()
+        conn.executemany(f"INSERT OR IGNORE INTO {LOCATION_MEMO_TABLE} (LocationsHash, Prefix, NonUS) VALUES (?, ?, ?)",
+                         ((self.key, prefix, int(non_us)) for prefix, non_us in new.items()))
+        return len(new)
+
+def locations_hash(locations: Iterable[str]) -> str:
+    return hashlib.sha256(json.dumps(list(locations)).encode()).hexdigest()
 
 def flatten_json(data: Dict) -> Dict:
     flattened = {}
@@ -25,14 +157,40 @@ def flatten_json(data: Dict) -> Dict:
             flattened[key] = value
     return flattened
 
-def filter_non_us(segments: List[Dict]) -> List[Dict]:
-    pattern = re.compile(r'\b(' + '|'.join(map(re.escape, NON_US_LOCATIONS)) + r')\b', re.IGNORECASE)
+def parse_segments(lines: Iterable[str], stats: StageStats) -> Iterator[Dict]:
+    for line in lines:
+        started = time.perf_counter()
+        segment = json.loads(line)
+        stats.add('parse', 1, time.perf_counter() - started)
+        yield segment
+
+def flatten_segments(segments: Iterable[Dict], stats: StageStats) -> Iterator[Dict]:
+    for segment in segments:
+        started = time.perf_counter()
+        flattened_segment = flatten_json(segment)
+        stats.add('flatten', 1, time.perf_counter() - started)
+        yield flattened_segment
+
+def iter_us_segments(segments: Iterable[Dict], stats: StageStats, memo: FullPathMemo = None) -> Iterator[Dict]:
+    """Yield only segments that mention no non-US location, using `memo` when given."""
+    matcher = get_location_matcher(NON_US_LOCATIONS)
     
-    def is_us_segment(segment):
+    for segment in segments:
+        started = time.perf_counter()
         search_text = f"{segment['FullPath']} {segment['BrandName']}"
-        return not pattern.search(search_text)
-    
-    filtered_segments = [segment for segment in segments if is_us_segment(segment)]
+        if memo is not None:
+            is_us_segment = not memo.is_non_us(search_text, stats)
+        else:
+            is_us_segment = not matcher.search(search_text)
+        stats.add('filter', 1, time.perf_counter() - started)
+        if is_us_segment:
+            yield segment
+        else:
+            stats.filtered_out += 1
+
+def filter_non_us(segments: List[Dict]) -> List[Dict]:
+    stats = StageStats()
+    filtered_segments = list(iter_us_segments(segments, stats))
     print(f"Filtered out {len(segments) - len(filtered_segments)} non-US locations")
     return filtered_segments
 
@@ -55,56 +213,347 @@ def print_random_rows(db_path: str, num_rows: int = 5):
     
     conn.close()
 
-def get_column_types(segments: List[Dict]) -> Dict[str, str]:
-    sample_segment = segments[0]
-    column_types = {}
-    
-    for key, value in sample_segment.items():
-        if isinstance(value, int):
-            column_types[key] = "INTEGER"
-        elif isinstance(value, float):
-            column_types[key] = "REAL"
-        else:
-            column_types[key] = "TEXT"
-    
-    return column_types
+def column_type(values: Iterable):
+    """SQLite type for a column holding `values`, or None if they are all NULL."""
+    kinds = {type(value) for value in values if value is not None}
+    if not kinds:
+        return None
+    if all(issubclass(kind, int) for kind in kinds):
+        return "INTEGER"
+    if all(issubclass(kind, (int, float)) for kind in kinds):
+        return "REAL"
+    return "TEXT"
+
+TYPE_RANK = {None: -1, "INTEGER": 0, "REAL": 1, "TEXT": 2}
+
+def merge_column_types(column_types: Dict[str, str], keys: Iterable[str], types: Iterable):
+    """Widen `column_types` in place (INTEGER < REAL < TEXT), adding new columns in order."""
+    for key, dtype in zip(keys, types):
+        if key not in column_types or TYPE_RANK[dtype] > TYPE_RANK[column_types[key]]:
+            column_types[key] = dtype
 
 def create_table(cursor, column_types: Dict[str, str]):
-    columns = ', '.join([f'"{col}" {dtype}' for col, dtype in column_types.items()])
-    cursor.execute(f'CREATE TABLE segments ({columns})')
+    """Create `segments` keyed by ThirdPartyDataId, with a content hash per row."""
+    columns = ', '.join([
+        # TEXT keeps the key from becoming a rowid alias and matches performance_summary
+        f'"{col}" TEXT PRIMARY KEY' if col == KEY_COLUMN else f'"{col}" {dtype}'
+        for col, dtype in column_types.items()
+    ])
+    cursor.execute(f'CREATE TABLE segments ({columns}, "{CONTENT_HASH_COLUMN}" TEXT NOT NULL)')
 
-def process_jsonl(input_file: str, output_db: str):
-    segments = []
-    
-    with open(input_file, 'r') as f:
-        for line in f:
-            segment = json.loads(line)
-            flattened_segment = flatten_json(segment)
-            segments.append(flattened_segment)
+def get_table_columns(cursor, table: str) -> List[str]:
+    return [row[1] for row in cursor.execute(f'PRAGMA table_info("{table}")')]
+
+def serialize_segment(segment: Dict) -> Tuple[str, str]:
+    """Return (content hash, canonical JSON) for a flattened segment."""
+    payload = json.dumps(segment, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest(), payload
+
+def group_rows(segments: Iterable[Dict], stats: StageStats,
+               batch_size: int = INSERT_BATCH_SIZE) -> Iterator[Tuple[Tuple[str, ...], List[tuple], List[Tuple[str, str]]]]:
+    """Group consecutive segments with the same columns into (columns, rows, (hash, JSON) records) batches."""
+    batch = []
+    records = []
+    keys = None
+    for segment in segments:
+        segment_keys = tuple(segment)
+        if batch and (segment_keys != keys or len(batch) >= batch_size):
+            yield keys, batch, records
+            batch = []
+            records = []
+        keys = segment_keys
+        batch.append(tuple(segment.values()))
+        started = time.perf_counter()
+        records.append(serialize_segment(segment))
+        stats.add('hash', 1, time.perf_counter() - started)
+    if batch:
+        yield keys, batch, records
+
+class SegmentStage:
+    """One run's segments, staged in a temp table and deduplicated on ThirdPartyDataId.
+
+    Rows are stored as JSON with their id and content hash, and column types are
+    inferred across every staged row. Rows repeating an (id, content hash) pair are
+    counted as exact copies, further distinct versions of an id as conflicting versions.
+    `resolve` then keeps one row per id: the last one staged, so the most recently
+    crawled page wins. A row repeating the content last staged for its id is dropped
+    early, using a bounded in-memory map of id to last content hash, as it would resolve
+    to the same content; the temp table catches anything the map missed.
+    """
+
+    def __init__(self, cursor, capacity: int = DEDUP_SEEN_CAPACITY):
+        self.cursor = cursor
+        self.capacity = capacity
+        self.last_hash = {}
+        self.column_types = {}
+        self.staged = 0
+        self.missing_key = 0
+        self.exact_duplicates = 0
+        self.conflicting_duplicates = 0
+        cursor.execute("DROP TABLE IF EXISTS temp.segment_stage")
+        cursor.execute("""
+            CREATE TEMP TABLE segment_stage (
+                StageRowid INTEGER PRIMARY KEY,
+                ThirdPartyDataId TEXT NOT NULL,
+                ContentHash TEXT NOT NULL,
+                Data TEXT NOT NULL
+            )
+        """)
+
+    def add(self, keys: Tuple[str, ...], rows: List[tuple], records: List[Tuple[str, str]]) -> int:
+        """Stage a batch of rows, minus repeats of their id's last staged content. Returns rows staged."""
+        if KEY_COLUMN not in keys:
+            self.missing_key += len(rows)
+            return 0
+        id_index = keys.index(KEY_COLUMN)
+        staged = []
+        for row, (row_hash, payload) in zip(rows, records):
+            third_party_id = row[id_index]
+            if third_party_id is None:
+                self.missing_key += 1
+                continue
+            if self.last_hash.get(third_party_id) == row_hash:
+                self.exact_duplicates += 1
+                continue
+            if len(self.last_hash) >= self.capacity:
+                self.last_hash.clear()  # Start a new generation, the temp table still catches repeats
+            self.last_hash[third_party_id] = row_hash
+            staged.append((str(third_party_id), row_hash, payload))
+        self.cursor.executemany("INSERT INTO temp.segment_stage (ThirdPartyDataId, ContentHash, Data) VALUES (?, ?, ?)", staged)
+        merge_column_types(self.column_types, keys, (column_type(values) for values in zip(*rows)))
+        self.staged += len(staged)
+        return len(staged)
+
+    def resolve(self) -> int:
+        """Drop the losing copies from the stage and return how many were dropped."""
+        self.cursor.execute("""
+            CREATE TEMP TABLE segment_duplicates AS
+            SELECT StageRowid, HashCopyNumber > 1 AS IsExact FROM (
+                SELECT StageRowid,
+                       ROW_NUMBER() OVER (PARTITION BY ThirdPartyDataId ORDER BY StageRowid DESC) AS CopyNumber,
+                       ROW_NUMBER() OVER (PARTITION BY ThirdPartyDataId, ContentHash ORDER BY StageRowid DESC) AS HashCopyNumber
+                FROM temp.segment_stage
+            ) WHERE CopyNumber > 1
+        """)
+        exact, conflicts = self.cursor.execute(
+            "SELECT COALESCE(SUM(IsExact), 0), COALESCE(SUM(1 - IsExact), 0) FROM temp.segment_duplicates").fetchone()
+        self.exact_duplicates += exact
+        self.conflicting_duplicates += conflicts
+        dropped = self.cursor.execute("DELETE FROM temp.segment_stage WHERE StageRowid IN (SELECT StageRowid FROM temp.segment_duplicates)").rowcount
+        self.cursor.execute("DROP TABLE temp.segment_duplicates")
+        self.cursor.execute("CREATE UNIQUE INDEX temp.idx_segment_stage_id ON segment_stage (ThirdPartyDataId)")
+        self.staged -= dropped
+        return dropped
+
+    def close(self):
+        self.cursor.execute("DROP TABLE IF EXISTS temp.segment_stage")
+
+def stage_rows(stage: SegmentStage, batches: Iterable[Tuple[Tuple[str, ...], List[tuple], List[Tuple[str, str]]]], stats: StageStats) -> int:
+    """Write (columns, rows, records) batches to the stage with executemany."""
+    staged = 0
+    for keys, rows, records in batches:
+        started = time.perf_counter()
+        staged += stage.add(keys, rows, records)
+        stats.add('stage', len(rows), time.perf_counter() - started)
+    return staged
+
+def prepare_segments_table(cursor, column_types: Dict[str, str]) -> List[str]:
+    """Create `segments` or add newly seen columns to it. Returns its data columns.
+
+    A table from before the keyed layout is rebuilt, so every segment counts as inserted.
+    """
+    columns = get_table_columns(cursor, 'segments')
+    if columns and CONTENT_HASH_COLUMN not in columns:
+        print("Rebuilding segments keyed by ThirdPartyDataId")
+        cursor.execute('DROP TABLE segments')
+        columns = []
+    if not columns:
+        create_table(cursor, column_types)
+    else:
+        for col, dtype in column_types.items():
+            if col not in columns:
+                cursor.execute(f'ALTER TABLE segments ADD COLUMN "{col}" {dtype}')
+                print(f"Added column {col} ({dtype}) to segments")
+    return [col for col in get_table_columns(cursor, 'segments') if col != CONTENT_HASH_COLUMN]
+
+def apply_segment_changes(cursor, columns: List[str], run_utc: str, stats: StageStats) -> Dict[str, int]:
+    """Upsert inserted and changed segments, delete removed ones and log them in segment_changes."""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (
+            RunUTC TEXT NOT NULL,
+            ThirdPartyDataId TEXT NOT NULL,
+            Action TEXT NOT NULL,
+            ContentHash TEXT
+        )
+    """)
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS "idx_{CHANGES_TABLE}_RunUTC" ON {CHANGES_TABLE} (RunUTC)')
+    cutoff = (datetime.utcnow() - timedelta(days=CHANGES_RETENTION_DAYS)).isoformat()
+    cursor.execute(f"DELETE FROM {CHANGES_TABLE} WHERE RunUTC < ?", (cutoff,))
+
+    started = time.perf_counter()
+    cursor.execute(f"""
+        INSERT INTO {CHANGES_TABLE} (RunUTC, ThirdPartyDataId, Action, ContentHash)
+        SELECT ?, s.ThirdPartyDataId, CASE WHEN t.ThirdPartyDataId IS NULL THEN 'insert' ELSE 'update' END, s.ContentHash
+        FROM temp.segment_stage s LEFT JOIN segments t ON t.ThirdPartyDataId = s.ThirdPartyDataId
+        WHERE t.ThirdPartyDataId IS NULL OR t."{CONTENT_HASH_COLUMN}" IS NOT s.ContentHash
+        ORDER BY s.StageRowid
+    """, (run_utc,))
+    cursor.execute(f"""
+        INSERT INTO {CHANGES_TABLE} (RunUTC, ThirdPartyDataId, Action, ContentHash)
+        SELECT ?, t.ThirdPartyDataId, 'delete', t."{CONTENT_HASH_COLUMN}"
+        FROM segments t WHERE NOT EXISTS (SELECT 1 FROM temp.segment_stage s WHERE s.ThirdPartyDataId = t.ThirdPartyDataId)
+    """, (run_utc,))
+    counts = dict(cursor.execute(f"SELECT Action, COUNT(*) FROM {CHANGES_TABLE} WHERE RunUTC = ? GROUP BY Action", (run_utc,)).fetchall())
+    stats.add('diff', sum(counts.values()), time.perf_counter() - started)
+
+    started = time.perf_counter()
+    cursor.execute(f"""
+        DELETE FROM segments WHERE ThirdPartyDataId IN
+            (SELECT ThirdPartyDataId FROM {CHANGES_TABLE} WHERE RunUTC = ? AND Action = 'delete')
+    """, (run_utc,))
+    target = ', '.join([f'"{col}"' for col in columns + [CONTENT_HASH_COLUMN]])
+    placeholders = ', '.join(['?' for _ in range(len(columns) + 1)])
+    updates = ', '.join([f'"{col}" = excluded."{col}"' for col in columns if col != KEY_COLUMN] + [f'"{CONTENT_HASH_COLUMN}" = excluded."{CONTENT_HASH_COLUMN}"'])
+    upsert_sql = f'INSERT INTO segments ({target}) VALUES ({placeholders}) ON CONFLICT ("{KEY_COLUMN}") DO UPDATE SET {updates}'
+    reader = cursor.connection.cursor()
+    reader.execute(f"""
+        SELECT s.Data, s.ContentHash FROM temp.segment_stage s
+        JOIN {CHANGES_TABLE} c ON c.ThirdPartyDataId = s.ThirdPartyDataId AND c.RunUTC = ? AND c.Action != 'delete'
+        ORDER BY s.StageRowid
+    """, (run_utc,))
+    upserted = 0
+    while True:
+        block = reader.fetchmany(INSERT_BATCH_SIZE)
+        if not block:
+            break
+        rows = []
+        for data, row_hash in block:
+            segment = json.loads(data)
+            rows.append(tuple(segment.get(col) for col in columns) + (row_hash,))
+        cursor.executemany(upsert_sql, rows)
+        upserted += len(rows)
+    stats.add('apply', upserted + counts.get('delete', 0), time.perf_counter() - started)
+    return counts
+
+def split_byte_ranges(input_file: str, chunk_bytes: int = CHUNK_BYTES) -> List[Tuple[int, int]]:
+    """Split a file into (start, end) byte ranges that begin and end on line boundaries."""
+    size = os.path.getsize(input_file)
+    ranges = []
+    with open(input_file, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()  # Move to the start of the next line
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+_worker_memo = None
+
+def init_worker(known: Dict[str, bool]):
+    global _worker_memo
+    _worker_memo = FullPathMemo(NON_US_LOCATIONS, known)
+
+def process_chunk(task: Tuple[str, int, int]) -> Tuple[List[Tuple[Tuple[str, ...], List[tuple]]], StageStats, Dict[str, bool]]:
+    """Parse, flatten and filter one byte range of the JSONL in a worker process.
+
+    Also returns the FullPath prefixes the worker classified for this chunk.
+    """
+    input_file, start, end = task
+    stats = StageStats()
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    segments = iter_us_segments(flatten_segments(parse_segments(lines, stats), stats), stats, _worker_memo)
+    return list(group_rows(segments, stats)), stats, _worker_memo.take_new()
+
+def next_tasks(tasks: Iterator, count: int) -> List:
+    return [task for _, task in zip(range(count), tasks)]
+
+def iter_parallel_batches(input_file: str, stats: StageStats, memo: FullPathMemo, workers: int,
+                          chunk_bytes: int = CHUNK_BYTES) -> Iterator[Tuple[Tuple[str, ...], List[tuple]]]:
+    """Yield (columns, rows) batches in file order, parsed and filtered by a process pool.
+
+    At most two chunks per worker are in flight so memory stays bounded when the
+    writer falls behind.
+    """
+    tasks = iter([(input_file, start, end) for start, end in split_byte_ranges(input_file, chunk_bytes)])
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(memo.known,)) as executor:
+        pending = deque(executor.submit(process_chunk, task) for task in next_tasks(tasks, workers * 2))
+        while pending:
+            batches, chunk_stats, classified = pending.popleft().result()
+            pending.extend(executor.submit(process_chunk, task) for task in next_tasks(tasks, 1))
+            stats.merge(chunk_stats)
+            memo.add(classified)
+            yield from batches
+
+def process_jsonl(input_file: str, output_db: str, workers: int = PARSE_WORKERS, chunk_bytes: int = CHUNK_BYTES):
+    """Stream the DMP JSONL through parse, flatten and filter, then upsert into `segments`.
+
+    Rows flow through generators into a temp staging table, so memory stays flat
+    regardless of file size. Repeated ThirdPartyDataIds are dropped (see SegmentStage),
+    then only inserted, changed and removed segments are written to `segments` and
+    logged in segment_changes, all in a single transaction. With `workers` > 1 the file
+    is split into line-aligned byte ranges that a process pool parses and filters; this
+    process stays the only SQLite writer and stages the batches in file order, so the
+    result is identical to a serial run.
+    """
+    stats = StageStats()
+    started = time.perf_counter()
+    run_utc = datetime.utcnow().isoformat()
+    counts = {}
     
-    filtered_segments = filter_non_us(segments)
+    conn = sqlite3.connect(output_db, isolation_level=None)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN')
+        memo = FullPathMemo.load(conn, NON_US_LOCATIONS)
+        stage = SegmentStage(cursor)
+        with open(input_file, 'r') as f:
+            if workers > 1:
+                batches = iter_parallel_batches(input_file, stats, memo, workers, chunk_bytes)
+            else:
+                batches = group_rows(iter_us_segments(flatten_segments(parse_segments(f, stats), stats), stats, memo), stats)
+            stage_rows(stage, batches, stats)
+        
+        if stage.staged:
+            started_dedup = time.perf_counter()
+            stage.resolve()
+            stats.add('dedup', stage.staged, time.perf_counter() - started_dedup)
+            column_types = {key: dtype or "TEXT" for key, dtype in stage.column_types.items()}
+            columns = prepare_segments_table(cursor, column_types)
+            counts = apply_segment_changes(cursor, columns, run_utc, stats)
+        stage.close()
+        memorized = memo.save(conn)
+        cursor.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
     
-    if not filtered_segments:
+    print(f"Filtered out {stats.filtered_out} non-US locations")
+    print(f"Saved {memorized} new FullPath prefixes to {LOCATION_MEMO_TABLE}")
+    if stage.missing_key:
+        print(f"Skipped {stage.missing_key} segments without a {KEY_COLUMN}")
+    if not stage.staged:
         print("No segments to process.")
         return
+    print(f"Dropped {stage.exact_duplicates + stage.conflicting_duplicates} duplicate ThirdPartyDataIds "
+          f"({stage.exact_duplicates} exact copies, {stage.conflicting_duplicates} conflicting versions)")
     
-    column_types = get_column_types(filtered_segments)
-    
-    conn = sqlite3.connect(output_db)
-    cursor = conn.cursor()
-    
-    cursor.execute('DROP TABLE IF EXISTS segments')
-    create_table(cursor, column_types)
-    
-    for segment in filtered_segments:
-        placeholders = ', '.join(['?' for _ in segment])
-        columns = ', '.join([f'"{k}"' for k in segment.keys()])
-        cursor.execute(f'INSERT INTO segments ({columns}) VALUES ({placeholders})', list(segment.values()))
-    
-    conn.commit()
-    conn.close()
-    
-    print(f"Processed {len(filtered_segments)} segments and stored them in {output_db}")
+    changed = sum(counts.values())
+    print(f"Processed {stage.staged} segments into {output_db} in {elapsed:.1f}s "
+          f"({stage.staged / max(elapsed, 1e-9):,.0f} rows/sec, {workers} worker{'s' if workers > 1 else ''}): "
+          f"{counts.get('insert', 0)} inserted, {counts.get('update', 0)} updated, {counts.get('delete', 0)} deleted, "
+          f"{stage.staged - counts.get('insert', 0) - counts.get('update', 0)} unchanged")
+    print(f"Recorded {changed} changes in {CHANGES_TABLE} for run {run_utc}")
+    if workers > 1:
+        print("  Parse, flatten and filter times are summed across workers")
+    stats.report()
     print_random_rows(output_db)
 
 def get_sorted_dmp_files(input_dir):
@@ -115,37 +564,111 @@ def get_sorted_dmp_files(input_dir):
 def cleanup_old_files(files_to_keep, all_files):
     files_to_delete = set(all_files) - set(files_to_keep)
     for file in files_to_delete:
+        # query_dmp's crawl ledger goes with its JSONL
+        for path in (file, f"{file}.checkpoint"):
+            if path != file and not os.path.exists(path):
+                continue
+            try:
+                os.remove(path)
+                print(f"Deleted old file: {path}")
+            except Exception as e:
+                print(f"Error deleting file {path}: {e}")
+
+def get_export_format(path: str) -> str:
+    """Infer the export format from the file extension."""
+    for export_format in sorted(EXPORT_FORMATS, key=len, reverse=True):
+        if path.endswith(f".{export_format}"):
+            return export_format
+    raise ValueError(f"Unsupported export file {path}, expected one of: {', '.join(EXPORT_FORMATS)}")
+
+def open_text_export(path: str, export_format: str):
+    if export_format == 'csv.gz':
+        return gzip.open(path, 'wt', newline='')
+    if export_format == 'csv.zst':
         try:
-            os.remove(file)
-            print(f"Deleted old file: {file}")
-        except Exception as e:
-            print(f"Error deleting file {file}: {e}")
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is required for .csv.zst exports") from None
+        return zstandard.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+def write_parquet_export(cursor, columns: List[str], column_types: Dict[str, str], path: str, batch_rows: int) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is required for .parquet exports") from None
+
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+    schema = pa.schema([(col, arrow_types.get(column_types.get(col), pa.string())) for col in columns])
+    rows_written = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            rows_written += len(rows)
+    return rows_written
+
+def export_to_csv(db_path: str, csv_path: str, batch_rows: int = EXPORT_BATCH_ROWS):
+    """Stream `segments` to `csv_path` in fetchmany blocks, so memory stays flat.
 
-def export_to_csv(db_path: str, csv_path: str):
+    The format follows the extension: .csv, .csv.gz, .csv.zst or .parquet. The file is
+    written under a temporary name and renamed into place once complete.
+    """
+    export_format = get_export_format(csv_path)
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    tmp_path = f"{csv_path}.tmp"
+    started = time.perf_counter()
     
-    cursor.execute("SELECT * FROM segments")
-    rows = cursor.fetchall()
-    
-    if rows:
-        columns = [description[0] for description in cursor.description]
+    try:
+        columns = [col for col in get_table_columns(cursor, 'segments') if col != CONTENT_HASH_COLUMN]
+        select_columns = ', '.join([f'"{col}"' for col in columns])
+        cursor.execute(f"SELECT {select_columns} FROM segments")
         
-        with open(csv_path, 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            csvwriter.writerow(columns)
-            csvwriter.writerows(rows)
+        if export_format == 'parquet':
+            column_types = {row[1]: row[2].upper() for row in conn.execute("PRAGMA table_info(segments)")}
+            rows_written = write_parquet_export(cursor, columns, column_types, tmp_path, batch_rows)
+        else:
+            rows_written = 0
+            with open_text_export(tmp_path, export_format) as csvfile:
+                csvwriter = csv.writer(csvfile)
+                csvwriter.writerow(columns)
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    csvwriter.writerows(rows)
+                    rows_written += len(rows)
         
-        print(f"Exported {len(rows)} rows to {csv_path}")
+        if rows_written:
+            os.replace(tmp_path, csv_path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    if rows_written:
+        elapsed = time.perf_counter() - started
+        print(f"Exported {rows_written} rows ({os.path.getsize(csv_path):,} bytes) to {csv_path} in {elapsed:.1f}s")
     else:
         print("No rows found in the database to export.")
-    
-    conn.close()
+    return rows_written
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flatten, filter and load the most recent DMP file")
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS,
+                        help="Worker processes for parsing and filtering, 1 to run serially (default: DMP_PARSE_WORKERS or CPU count)")
+    parser.add_argument('--export-format', choices=EXPORT_FORMATS, default='csv',
+                        help="Format of the exported segments file (default: csv)")
+    args = parser.parse_args()
+
     input_dir = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/jsonl"
     output_db = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db"
-    output_csv = "/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/element_performance.csv"
+    output_csv = f"/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/element_performance.{args.export_format}"
     
     try:
         dmp_files = get_sorted_dmp_files(input_dir)
@@ -154,7 +677,7 @@ if __name__ == "__main__":
         
         input_file = dmp_files[0]
         print(f"Processing most recent file: {input_file}")
-        process_jsonl(input_file, output_db)
+        process_jsonl(input_file, output_db, workers=args.workers)
         
         print("Exporting database to CSV...")
         export_to_csv(output_db, output_csv)
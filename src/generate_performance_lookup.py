@@ -1,38 +1,42 @@
 import pandas as pd
 import sqlite3
-import openai
-from fuzzywuzzy import process
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import numpy as np
+from rapidfuzz import process, fuzz, utils
 import os
 import logging
+import hashlib
+from datetime import datetime
 from typing import Set
 from dotenv import load_dotenv
-import requests
 from requests.exceptions import RequestException
-
-# Import functions from query_dmp.py
-from query_dmp import get_auth_token
+from ttd_client import get_client
+from llm_categorizer import LLMCategorizer, LLM_MODEL
 
 # Load environment variables
 load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
 
-# Set up OpenAI API key
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-TTD_USERNAME = os.getenv('TTD_USERNAME')
-TTD_PASS = os.getenv('TTD_PASS')
 PARTNER_ID = os.getenv('PARTNER_ID')
 
+# Bump when the categorization prompts or model change so cached results are redone
+PROMPT_VERSION = 2
+CACHE_TABLE = 'advertiser_vertical_cache'
+MAPPING_COLUMNS = ['Advertiser', 'Matched_Company', 'Vertical', 'Match_Score', 'Categorization_Technique']
+COLUMNS_TO_CHECK = ['Company Name', 'Quickbooks Customer Name', 'Client Group']
+MATCH_CHUNK_SIZE = 500  # Advertisers scored per cdist call, bounds the score matrix size
+# Fuzzy matches scoring at least this much are accepted without asking the LLM
+FUZZY_MATCH_THRESHOLD = float(os.getenv('FUZZY_MATCH_THRESHOLD', 95))
+LEGAL_SUFFIXES = {'inc', 'incorporated', 'llc', 'llp', 'lp', 'ltd', 'limited', 'corp', 'corporation',
+                  'co', 'company', 'plc', 'gmbh', 'pllc', 'pc', 'sa', 'ag', 'pty', 'holdings'}
+TIERS = ['Exact Match', 'Normalized Match', 'Fuzzy Match', 'Matched', 'AI Categorized']
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_all_advertiser_names(token: str, partner_id: str) -> Set[str]:
+def get_all_advertiser_names(partner_id: str) -> Set[str]:
     """Retrieve all advertiser names."""
-    url = f"https://api.thetradedesk.com/v3/overview/partner/{partner_id}"
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
-    
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        response = get_client().get(f"overview/partner/{partner_id}")
         partner_overview = response.json()
         
         all_advertiser_ids = set()
@@ -48,109 +52,211 @@ def load_categorizations(file_path):
     """Load the CSV file with advertiser categorizations."""
     return pd.read_csv(file_path)
 
-def get_top_matches(name, choices, n=10):
-    return process.extract(name, choices, limit=n)
+def normalize_company_name(name):
+    """Lowercase, strip punctuation and drop trailing legal suffixes such as Inc or LLC."""
+    tokens = utils.default_process(str(name)).split()
+    while tokens and tokens[-1] in LEGAL_SUFFIXES:
+        tokens.pop()
+    return ' '.join(tokens)
 
-def llm_choose_match(advertiser_name, top_matches):
-    matches_str = "\n".join([f"{match[0]} (Score: {match[1]})" for match in top_matches])
-    prompt = f"""
-    Given the advertiser name "{advertiser_name}", choose the best matching company from the following list:
-    {matches_str}
+class MatchIndex:
+    """Prebuilt fuzzy-matching index over the categorization columns.
 
-    Respond with only the exact company name you've chosen, no explanation or anything else.
-    If none of the options seem like a good match, respond with "No match".
+    Candidates are deduplicated once per column and every advertiser is scored against
+    all of them in batched rapidfuzz `cdist` calls, which run multi-threaded in native
+    code outside the GIL. Chosen matches resolve to their vertical with a dict lookup.
     """
 
+    def __init__(self, df_lookup, columns=COLUMNS_TO_CHECK, workers=-1):
+        self.columns = columns
+        self.workers = workers
+        self.choices = {}
+        self.processed = {}
+        self.verticals = {}
+        for column in columns:
+            names = df_lookup[column]
+            self.choices[column] = names.dropna().astype(str).unique().tolist()
+            # Normalized once here instead of on every comparison
+            self.processed[column] = [utils.default_process(choice) for choice in self.choices[column]]
+            # First row wins, as with the former df_lookup.loc[...].iloc[0] lookup
+            column_verticals = {}
+            for name, vertical in zip(names, df_lookup['Client Industry Value']):
+                if pd.notna(name):
+                    column_verticals.setdefault(str(name), vertical)
+            self.verticals[column] = column_verticals
+        # Normalized name -> (vertical, candidate), earlier columns and rows win. Names that
+        # normalize alike but point to different verticals are ambiguous and left out.
+        self.normalized = {}
+        conflicting = set()
+        for column in columns:
+            for name, vertical in self.verticals[column].items():
+                key = normalize_company_name(name)
+                if not key:
+                    continue
+                if key not in self.normalized:
+                    self.normalized[key] = (vertical, name)
+                elif not (self.normalized[key][0] == vertical or (pd.isna(self.normalized[key][0]) and pd.isna(vertical))):
+                    conflicting.add(key)
+        for key in conflicting:
+            del self.normalized[key]
 
-    response = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that matches advertisers to companies."},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=50,
-        n=1,
-        stop=None,
-        temperature=0,
-    )
-    chosen_match = response.choices[0].message.content.strip()
-    return chosen_match if chosen_match != "No match" else None
-
-def categorize_advertiser(advertiser_name, categories, df_lookup, columns_to_check):
-    def fetch_top_matches(column):
-        return get_top_matches(advertiser_name, df_lookup[column].unique())
-
-    # First, try to find a match using the LLM in parallel
-    with ThreadPoolExecutor() as executor:
-        future_to_column = {executor.submit(fetch_top_matches, column): column for column in columns_to_check}
-        all_top_matches = []
-        for future in as_completed(future_to_column):
-            all_top_matches.extend(future.result())
-
-    chosen_match = llm_choose_match(advertiser_name, all_top_matches)
-
-    if chosen_match:
-        # Find the vertical for the chosen match
-        for column in columns_to_check:
-            if chosen_match in df_lookup[column].values:
-                vertical = df_lookup.loc[df_lookup[column] == chosen_match, 'Client Industry Value'].iloc[0]
-                return vertical, chosen_match, 'Matched'
+    def top_matches(self, names, n=10):
+        """Return {name: [(candidate, score), ...]} with the top `n` candidates per column."""
+        names = list(names)
+        results = {name: [] for name in names}
+        for column in self.columns:
+            choices = self.choices[column]
+            if not choices:
+                continue
+            k = min(n, len(choices))
+            for start in range(0, len(names), MATCH_CHUNK_SIZE):
+                chunk = names[start:start + MATCH_CHUNK_SIZE]
+                queries = [utils.default_process(name) for name in chunk]
+                scores = process.cdist(queries, self.processed[column], scorer=fuzz.WRatio,
+                                       dtype=np.float32, workers=self.workers)
+                # k-th best score per row; ties at the cut are broken by candidate order
+                kth = -np.partition(-scores, k - 1, axis=1)[:, k - 1]
+                for row, name in enumerate(chunk):
+                    above = np.flatnonzero(scores[row] > kth[row])
+                    tied = np.flatnonzero(scores[row] == kth[row])[:k - len(above)]
+                    best = sorted(np.concatenate([above, tied]), key=lambda i: (-scores[row, i], i))
+                    results[name].extend((choices[i], round(float(scores[row, i]))) for i in best)
+        return results
 
-    # If no match is found, use the original categorization method
-    prompt = f"""
-    Given the advertiser name "{advertiser_name}", choose the most appropriate category from the following list:
-    {', '.join(categories)}
-    
-    Respond with only the category name precisely as written, no explanation or anything else, your response is being used to fill in a spreadsheet.
+    def resolve(self, chosen_match):
+        """Return (vertical, found) for a chosen candidate name."""
+        for column in self.columns:
+            if chosen_match in self.verticals[column]:
+                return self.verticals[column][chosen_match], True
+        return None, False
+
+    def resolve_normalized(self, name):
+        """Return (vertical, candidate) for a candidate with the same normalized name, or None."""
+        key = normalize_company_name(name)
+        return self.normalized.get(key) if key else None
+
+    def resolve_confident(self, matches, threshold):
+        """Return (vertical, candidate, score) when the fuzzy matches leave no doubt, or None.
+
+        The best candidate must score at least `threshold`, and every candidate above the
+        threshold must point to the same vertical; anything else is left to the LLM.
+        """
+        confident = [(candidate, score) for candidate, score in matches if score >= threshold]
+        if not confident:
+            return None
+        verticals = {self.resolve(candidate)[0] for candidate, _ in confident}
+        if len(verticals) != 1:
+            return None
+        candidate, score = max(confident, key=lambda match: match[1])
+        return verticals.pop(), candidate, score
+
+async def categorize_advertisers(advertisers, categories, match_index, top_matches, categorizer):
+    """Return {advertiser: (vertical, matched_name, technique)} using batched LLM calls.
+
+    The LLM first picks among each advertiser's fuzzy candidates; advertisers without a
+    usable match are then categorized directly. Advertisers whose batches failed, or that
+    the model left unanswered, are left out so they are retried on the next run.
     """
+    chosen = await categorizer.choose_matches({advertiser: top_matches[advertiser] for advertiser in advertisers})
 
-    response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that categorizes advertisers."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=50,
-            n=1,
-            stop=None,
-            temperature=0,
-        )
+    results = {}
+    unmatched = []
+    for advertiser, chosen_match in chosen.items():
+        if chosen_match:
+            # Find the vertical for the chosen match
+            vertical, found = match_index.resolve(chosen_match)
+            if found:
+                results[advertiser] = (vertical, chosen_match, 'Matched')
+                continue
+        unmatched.append(advertiser)
 
-    category = response.choices[0].message.content.strip()
-    if category not in categories:
-        return "Uncategorized", None, 'AI Categorized'
+    # If no match is found, use the original categorization method
+    categorized = await categorizer.categorize(unmatched, categories)
+    for advertiser, category in categorized.items():
+        results[advertiser] = (category, None, 'AI Categorized')
+    return results
 
-    return category, None, 'AI Categorized'
 
+def log_tier_stats(df, total):
+    """Log how many advertisers each resolution tier handled."""
+    if not total:
+        return
+    counts = df['Categorization_Technique'].value_counts() if not df.empty else {}
+    parts = [f"{tier} {counts.get(tier, 0)} ({counts.get(tier, 0) / total:.1%})" for tier in TIERS]
+    failed = total - len(df)
+    if failed:
+        parts.append(f"failed {failed} ({failed / total:.1%})")
+    logging.info(f"Resolved {total} advertisers: " + ", ".join(parts))
 
-def create_vertical_mapping(advertisers, df_lookup):
-    columns_to_check = ['Company Name', 'Quickbooks Customer Name', 'Client Group']
-    categories = df_lookup['Client Industry Value'].dropna().unique().tolist()
-    
+
+def mapping_row(advertiser, vertical, matched_name, score, technique):
+    return {
+        'Advertiser': advertiser,
+        'Matched_Company': matched_name if matched_name else 'NO MATCH',
+        'Vertical': vertical,
+        'Match_Score': score,
+        'Categorization_Technique': technique
+    }
+
+def resolve_locally(advertisers, match_index, threshold=FUZZY_MATCH_THRESHOLD):
+    """Resolve what the exact, normalized and fuzzy tiers can without the LLM.
+
+    Returns (mapping rows, ambiguous advertisers, top fuzzy matches per unresolved advertiser).
+    """
     vertical_mapping = []
+    unresolved = []
+    for advertiser in advertisers:
+        vertical, found = match_index.resolve(advertiser)
+        if found:
+            vertical_mapping.append(mapping_row(advertiser, vertical, advertiser, 100, 'Exact Match'))
+            continue
+        normalized = match_index.resolve_normalized(advertiser)
+        if normalized:
+            vertical_mapping.append(mapping_row(advertiser, normalized[0], normalized[1], 100, 'Normalized Match'))
+            continue
+        unresolved.append(advertiser)
+    
+    # Score the rest against all candidates in one batched pass
+    top_matches = match_index.top_matches(unresolved)
+    logging.info(f"Computed fuzzy matches for {len(top_matches)} advertisers")
     
-    def process_advertiser(advertiser):
-        vertical, matched_name, matched_column = categorize_advertiser(advertiser, categories, df_lookup, columns_to_check)
-        return {
-            'Advertiser': advertiser,
-            'Matched_Company': matched_name if matched_name else 'NO MATCH',
-            'Vertical': vertical,
-            'Match_Score': None,  # We don't have a score for LLM matching
-            'Categorization_Technique': matched_column
-        }
+    ambiguous = []
+    for advertiser in unresolved:
+        confident = match_index.resolve_confident(top_matches[advertiser], threshold)
+        if confident:
+            vertical_mapping.append(mapping_row(advertiser, confident[0], confident[1], confident[2], 'Fuzzy Match'))
+        else:
+            ambiguous.append(advertiser)
+    return vertical_mapping, ambiguous, top_matches
+
+def create_vertical_mapping(advertisers, df_lookup, categorizer=None, threshold=FUZZY_MATCH_THRESHOLD):
+    """Resolve advertisers to verticals, cheapest tier first.
+
+    Exact and normalized name matches resolve locally, then fuzzy matches scoring at
+    least `threshold` without a competing vertical. Only the remaining ambiguous
+    advertisers go to the LLM.
+    """
+    categories = df_lookup['Client Industry Value'].dropna().unique().tolist()
+    match_index = MatchIndex(df_lookup)
+    advertisers = list(advertisers)
+    
+    vertical_mapping, ambiguous, top_matches = resolve_locally(advertisers, match_index, threshold)
     
-    with ThreadPoolExecutor(max_workers=50) as executor:  # Adjust max_workers as needed
-        future_to_advertiser = {executor.submit(process_advertiser, advertiser): advertiser for advertiser in advertisers}
-        for future in as_completed(future_to_advertiser):
-            advertiser = future_to_advertiser[future]
-            try:
-                result = future.result()
-                vertical_mapping.append(result)
-                logging.info(f"Processed advertiser: {advertiser}")
-            except Exception as exc:
-                logging.error(f"Advertiser {advertiser} generated an exception: {exc}")
+    if ambiguous:
+        categorizer = categorizer or LLMCategorizer()
+        results = asyncio.run(categorize_advertisers(ambiguous, categories, match_index, top_matches, categorizer))
+        logging.info(f"Sent {len(ambiguous)} ambiguous advertisers to the LLM")
+        categorizer.log_stats()
+        failed = len(ambiguous) - len(results)
+        if failed:
+            logging.error(f"{failed} advertisers could not be categorized and will be retried on the next run")
+        for advertiser, (vertical, matched_name, technique) in results.items():
+            # We don't have a score for LLM matching
+            vertical_mapping.append(mapping_row(advertiser, vertical, matched_name, None, technique))
     
-    return pd.DataFrame(vertical_mapping)
+    df_mapping = pd.DataFrame(vertical_mapping, columns=MAPPING_COLUMNS)
+    log_tier_stats(df_mapping, len(advertisers))
+    return df_mapping
 
 def save_to_sqlite(df, db_path, table_name):
     """Save DataFrame to SQLite database."""
@@ -184,25 +290,101 @@ def load_vertical_mapping(csv_path):
         return df
     return None
 
+def get_cache_key(categorizations_file):
+    """Hash of the categorizations file, prompt version and fuzzy threshold that cached results depend on."""
+    sha = hashlib.sha256()
+    with open(categorizations_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    sha.update(f"|{PROMPT_VERSION}|{LLM_MODEL}|{FUZZY_MATCH_THRESHOLD}".encode())
+    return sha.hexdigest()
+
+def load_cached_mapping(conn, cache_key):
+    """Return cached categorizations made under `cache_key`."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CACHE_TABLE} (
+            Advertiser TEXT PRIMARY KEY,
+            Matched_Company TEXT,
+            Vertical TEXT,
+            Match_Score REAL,
+            Categorization_Technique TEXT,
+            CacheKey TEXT NOT NULL,
+            CategorizedUTC TEXT NOT NULL
+        )
+    """)
+    columns = ', '.join(MAPPING_COLUMNS)
+    return pd.read_sql_query(f"SELECT {columns} FROM {CACHE_TABLE} WHERE CacheKey = ?", conn, params=(cache_key,))
+
+def save_cached_mapping(conn, df, cache_key):
+    """Insert or replace categorizations in the cache under `cache_key`."""
+    now = datetime.utcnow().isoformat()
+    rows = [
+        tuple(None if pd.isna(row[col]) else row[col] for col in MAPPING_COLUMNS) + (cache_key, now)
+        for _, row in df.iterrows()
+    ]
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO {CACHE_TABLE} ({', '.join(MAPPING_COLUMNS)}, CacheKey, CategorizedUTC)
+        VALUES ({', '.join('?' for _ in MAPPING_COLUMNS)}, ?, ?)
+    """, rows)
+    conn.commit()
+
+def get_vertical_mapping(advertisers, df_lookup, db_path, cache_key, seed_csv=None):
+    """Categorize only advertisers missing from the cache and return the merged mapping.
+
+    The result holds every advertiser cached under the current key, including ones that
+    no longer appear in the API, so report_stack rows for them keep their vertical. When
+    the key changes, every cached advertiser is categorized again under the new one.
+    """
+    conn = sqlite3.connect(db_path)
+    cache_exists = conn.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name=?", (CACHE_TABLE,)).fetchone()
+    first_run = not cache_exists or conn.execute(f"SELECT COUNT(*) FROM {CACHE_TABLE}").fetchone()[0] == 0
+    cached = load_cached_mapping(conn, cache_key)
+
+    if first_run and seed_csv:
+        # One-time migration: start from the mapping written by the last uncached run. Once the
+        # cache holds anything, a key with no rows means it was invalidated, so never reseed then.
+        seeded = load_vertical_mapping(seed_csv)
+        if seeded is not None and set(MAPPING_COLUMNS).issubset(seeded.columns):
+            seeded = seeded[MAPPING_COLUMNS]
+            # The local tiers are free, so apply them to seeded advertisers too; only the
+            # LLM answers for advertisers they cannot resolve are carried over
+            local_rows, _, _ = resolve_locally(seeded['Advertiser'], MatchIndex(df_lookup))
+            df_local = pd.DataFrame(local_rows, columns=MAPPING_COLUMNS)
+            seeded = pd.concat([seeded[~seeded['Advertiser'].isin(df_local['Advertiser'])], df_local])
+            save_cached_mapping(conn, seeded, cache_key)
+            cached = load_cached_mapping(conn, cache_key)
+
+    # Advertisers cached under an older key are redone too, so they stay in the lookup
+    known = set(advertisers) | {row[0] for row in conn.execute(f"SELECT Advertiser FROM {CACHE_TABLE}")}
+    new_advertisers = known - set(cached['Advertiser'])
+    logging.info(f"{len(known) - len(new_advertisers)} advertisers cached, {len(new_advertisers)} to categorize")
+
+    if new_advertisers:
+        df_new = create_vertical_mapping(new_advertisers, df_lookup)
+        if not df_new.empty:
+            save_cached_mapping(conn, df_new, cache_key)
+
+    merged = load_cached_mapping(conn, cache_key)
+    conn.close()
+    return merged
+
 if __name__ == "__main__":
     categorizations_file = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/categorizations.csv'
     output_db = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db'
     table_name = 'advertiser_vertical_lookup'
     output_csv = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/advertiser_vertical_lookup.csv'
 
-    # Get authentication token
-    token = get_auth_token()
-
     # Get all advertiser names
-    advertiser_names = get_all_advertiser_names(token, PARTNER_ID)
+    advertiser_names = get_all_advertiser_names(PARTNER_ID)
     logging.info(f"Retrieved {len(advertiser_names)} advertiser names from API")
+    get_client().log_stats()
 
     # Load categorizations
     df_categorizations = load_categorizations(categorizations_file)
 
-    # Create vertical mapping
-    logging.info("Creating vertical mapping for all advertisers.")
-    df_matched = create_vertical_mapping(advertiser_names, df_categorizations)
+    # Create vertical mapping, reusing cached categorizations
+    cache_key = get_cache_key(categorizations_file)
+    df_matched = get_vertical_mapping(advertiser_names, df_categorizations, output_db, cache_key, seed_csv=output_csv)
     
     # Save df_matched as CSV
     df_matched.to_csv(output_csv, index=False)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+import openai
+from openai import AsyncOpenAI
+
+##############################################################################################
+# Batched, rate-limited LLM categorization of advertisers.
+# Several advertisers are packed into one structured-output chat completion, requests run
+# concurrently under requests-per-minute and tokens-per-minute budgets, and failed calls
+# back off and retry. Set OPENAI_BASE_URL to run against a local fake completion server.
+##############################################################################################
+
+LLM_MODEL = "gpt-4o-mini"
+LLM_BATCH_SIZE = 20
+LLM_MAX_CONCURRENCY = 8
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 200000))
+LLM_MAX_RETRIES = 5
+TOKENS_PER_ANSWER = 40  # Completion budget per advertiser in a batch
+
+
+class AsyncRateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets shared by concurrent calls."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.token_capacity)
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+                self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+                if now >= self.paused_until and self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                delay = max(self.paused_until - now,
+                            (1 - self.requests) / self.request_rate,
+                            (tokens - self.tokens) / self.token_rate)
+            await asyncio.sleep(max(delay, 0.01))
+
+    def pause(self, seconds: float):
+        """Hold every caller back, e.g. after a 429 with Retry-After."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """Rough prompt size (4 characters per token) plus the completion budget."""
+    return sum(len(message['content']) for message in messages) // 4 + max_tokens
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMCategorizer:
+    """Async engine that matches and categorizes advertisers in batches."""
+
+    def __init__(self, client: AsyncOpenAI = None, model: str = LLM_MODEL, batch_size: int = LLM_BATCH_SIZE,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = LLM_TOKENS_PER_MINUTE, max_retries: int = LLM_MAX_RETRIES):
+        # Retries are handled here so they respect the shared budgets
+        self.client = client or AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+        self.model = model
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.limiter = AsyncRateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.latencies = []
+        self.stats = {"calls": 0, "retries": 0, "failed_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    async def _complete(self, messages: List[Dict[str, str]], schema: Dict, max_tokens: int) -> Dict:
+        """Send one structured-output completion with backoff. Returns the parsed JSON."""
+        delay = 1.0
+        for attempt in range(self.max_retries):
+            await self.limiter.acquire(estimate_tokens(messages, max_tokens))
+            started = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    response_format={"type": "json_schema", "json_schema": {"name": "results", "strict": True, "schema": schema}},
+                )
+                self.latencies.append(time.perf_counter() - started)
+                self.stats["calls"] += 1
+                if response.usage:
+                    self.stats["prompt_tokens"] += response.usage.prompt_tokens
+                    self.stats["completion_tokens"] += response.usage.completion_tokens
+                return json.loads(response.choices[0].message.content)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError, json.JSONDecodeError) as e:
+                self.latencies.append(time.perf_counter() - started)
+                if attempt == self.max_retries - 1:
+                    self.stats["failed_calls"] += 1
+                    raise
+                wait = _retry_after(e) or delay * (1 + random.random())
+                if isinstance(e, openai.RateLimitError):
+                    self.limiter.pause(wait)
+                self.stats["retries"] += 1
+                logging.warning(f"LLM call failed ({type(e).__name__}). Retrying in {wait:.1f} seconds...")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, 60)
+
+    async def _choose_batch(self, batch: List[Tuple[str, List[Tuple[str, int]]]]) -> Dict[str, Optional[str]]:
+        lines = []
+        for i, (advertiser, top_matches) in enumerate(batch):
+            matches_str = "; ".join(f"{match} (Score: {score})" for match, score in top_matches)
+            lines.append(f'{i}. Advertiser "{advertiser}": {matches_str}')
+        prompt = (
+            "For each advertiser below, choose the best matching company from its own candidate list.\n"
+            + "\n".join(lines)
+            + "\n\nReturn one result per advertiser id with the exact company name you've chosen, "
+            "or null if none of the options seem like a good match."
+        )
+        schema = {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "match": {"type": ["string", "null"]}},
+                "required": ["id", "match"], "additionalProperties": False}}},
+            "required": ["results"], "additionalProperties": False,
+        }
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant that matches advertisers to companies."},
+            {"role": "user", "content": prompt},
+        ]
+        result = await self._complete(messages, schema, TOKENS_PER_ANSWER * len(batch))
+        # Advertisers the model left out are not in the result, so they are retried next run
+        return {batch[item['id']][0]: item['match'] for item in result['results'] if 0 <= item['id'] < len(batch)}
+
+    async def _categorize_batch(self, advertisers: List[str], categories: List[str]) -> Dict[str, str]:
+        lines = [f'{i}. "{advertiser}"' for i, advertiser in enumerate(advertisers)]
+        prompt = (
+            "For each advertiser below, choose the most appropriate category from the following list:\n"
+            f"{', '.join(categories)}\n\nAdvertisers:\n" + "\n".join(lines)
+            + "\n\nReturn one result per advertiser id with the category name precisely as written."
+        )
+        schema = {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": {
+                "type": "object",
+                "properties": {"id": {"type": "integer"}, "category": {"type": "string", "enum": categories}},
+                "required": ["id", "category"], "additionalProperties": False}}},
+            "required": ["results"], "additionalProperties": False,
+        }
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant that categorizes advertisers."},
+            {"role": "user", "content": prompt},
+        ]
+        result = await self._complete(messages, schema, TOKENS_PER_ANSWER * len(advertisers))
+        # Advertisers the model left out are not in the result, so they are retried next run
+        chosen = {advertisers[item['id']]: item['category'] for item in result['results'] if 0 <= item['id'] < len(advertisers)}
+        return {advertiser: category if category in categories else "Uncategorized" for advertiser, category in chosen.items()}
+
+    async def _run_batches(self, batches, handler):
+        """Run `handler` over batches with bounded concurrency, merging results.
+
+        Batches that still fail after retries are logged and left out of the result.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = {}
+
+        async def run(batch):
+            async with semaphore:
+                try:
+                    results.update(await handler(batch))
+                except Exception as e:
+                    logging.error(f"LLM batch of {len(batch)} advertisers failed: {e}")
+
+        await asyncio.gather(*(run(batch) for batch in batches))
+        return results
+
+    async def choose_matches(self, candidates: Dict[str, List[Tuple[str, int]]]) -> Dict[str, Optional[str]]:
+        """Pick the best candidate (or None) for each advertiser. Advertisers without an answer are left out."""
+        items = list(candidates.items())
+        batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        return await self._run_batches(batches, self._choose_batch)
+
+    async def categorize(self, advertisers: List[str], categories: List[str]) -> Dict[str, str]:
+        """Pick a category for each advertiser, "Uncategorized" if the answer is not in the list.
+
+        Advertisers without an answer are left out, as are all of them when there are no
+        categories to choose from, so they are retried on a later run.
+        """
+        advertisers = list(advertisers)
+        if not advertisers:
+            return {}
+        if not categories:
+            # The structured-output enum would be empty
+            logging.error(f"No categories to choose from, leaving {len(advertisers)} advertisers uncategorized: {advertisers}")
+            return {}
+        batches = [advertisers[i:i + self.batch_size] for i in range(0, len(advertisers), self.batch_size)]
+        return await self._run_batches(batches, lambda batch: self._categorize_batch(batch, categories))
+
+    def log_stats(self):
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            latency = f", latency p50 {p50:.2f}s p95 {p95:.2f}s max {latencies[-1]:.2f}s"
+        else:
+            latency = ""
+        s = self.stats
+        logging.info(f"LLM: {s['calls']} calls ({s['retries']} retries, {s['failed_calls']} failed), "
+                     f"{s['prompt_tokens']:,} prompt + {s['completion_tokens']:,} completion tokens{latency}")
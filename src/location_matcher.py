@@ -0,0 +1,77 @@
+import re
+from functools import lru_cache
+from typing import Iterable, Tuple
+
+##############################################################################################
+# Fast word-boundary location matching for the non-US segment filter.
+# Equivalent to re.search(r'\b(loc1|loc2|...)\b', text, re.IGNORECASE), but for ASCII
+# text it looks up candidate phrases in a set, anchored on word runs, instead of trying
+# every alternative at every position.
+##############################################################################################
+
+WORD_RUN = re.compile(r'\w+')
+WORD_EDGES = re.compile(r'\w(.*\w)?', re.DOTALL)
+
+
+def build_pattern(locations: Iterable[str]) -> re.Pattern:
+    return re.compile(r'\b(' + '|'.join(map(re.escape, locations)) + r')\b', re.IGNORECASE)
+
+
+def _can_match_ascii(location: str) -> bool:
+    """Whether `location` could match some ASCII text case-insensitively (e.g. the Kelvin sign matches 'k')."""
+    return all(char.isascii() or any(re.fullmatch(re.escape(char), chr(code), re.IGNORECASE) for code in range(128))
+               for char in location)
+
+
+class LocationMatcher:
+    """Case-insensitive, word-bounded search for any of a list of locations.
+
+    ASCII locations that start and end with a word character are kept in a lowercase
+    phrase set. In ASCII text such a phrase can only match from the start of a word run
+    to the end of a later one, so the search tries those spans, and only from runs that
+    begin some phrase. Every other location, and any non-ASCII text, goes through the
+    regex so results stay identical to it.
+    """
+
+    def __init__(self, locations: Iterable[str]):
+        locations = list(locations)
+        self.pattern = build_pattern(locations)
+        self.phrases = set()
+        residual = []
+        for location in locations:
+            if location.isascii() and WORD_EDGES.fullmatch(location):
+                self.phrases.add(location.lower())
+            elif _can_match_ascii(location):
+                residual.append(location)
+        self.first_words = {WORD_RUN.match(phrase).group() for phrase in self.phrases}
+        self.max_length = max(map(len, self.phrases), default=0)
+        self.residual = build_pattern(residual) if residual else None
+
+    def search(self, text: str) -> bool:
+        """Return True if `text` mentions any location."""
+        if not text.isascii():
+            return self.pattern.search(text) is not None
+        if self.residual is not None and self.residual.search(text):
+            return True
+
+        lowered = text.lower()
+        runs = [(match.start(), match.end()) for match in WORD_RUN.finditer(lowered)]
+        for i, (start, end) in enumerate(runs):
+            if lowered[start:end] not in self.first_words:
+                continue
+            for _, run_end in runs[i:]:
+                if run_end - start > self.max_length:
+                    break
+                if lowered[start:run_end] in self.phrases:
+                    return True
+        return False
+
+
+@lru_cache(maxsize=None)
+def _cached_matcher(locations: Tuple[str, ...]) -> LocationMatcher:
+    return LocationMatcher(locations)
+
+
+def get_location_matcher(locations: Iterable[str]) -> LocationMatcher:
+    """Return the matcher for `locations`, built once per process."""
+    return _cached_matcher(tuple(locations))
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+##############################################################################################
+# Sharded pinecone_data.jsonl.
+# prepare_pinecone_jsonl writes records into N shards, partitioned by a stable hash of
+# ThirdPartyDataId, plus a manifest next to the main path. Readers go through the
+# manifest, parse shards in parallel and, given the ids they need, read only the shards
+# holding those ids. A path without a manifest is read as a single JSONL file.
+##############################################################################################
+
+MANIFEST_SUFFIX = '.manifest.json'
+LOAD_WORKERS = int(os.getenv('PINECONE_JSONL_WORKERS', os.cpu_count() or 1))
+
+
+def manifest_path(jsonl_path: str) -> str:
+    return os.path.splitext(jsonl_path)[0] + MANIFEST_SUFFIX
+
+
+def shard_paths(jsonl_path: str, shards: int) -> List[str]:
+    """One file per shard; a single shard is written to `jsonl_path` itself."""
+    if shards == 1:
+        return [jsonl_path]
+    root, ext = os.path.splitext(jsonl_path)
+    return [f"{root}-{shard:05d}-of-{shards:05d}{ext}" for shard in range(shards)]
+
+
+def shard_for_id(third_party_id: str, shards: int) -> int:
+    """Shard of a ThirdPartyDataId. Stable across runs and processes, unlike hash()."""
+    digest = hashlib.blake2b(str(third_party_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+class ShardedJsonlWriter:
+    """Write pre-serialized JSONL lines into hash-partitioned shards, then the manifest.
+
+    Shards are written to `.tmp` files and moved into place only in `close()`, right
+    before the manifest, which is itself replaced atomically. Readers of the previous
+    output never see truncated shards or a manifest listing files from an unfinished run.
+    """
+
+    def __init__(self, jsonl_path: str, shards: int = 1):
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, got {shards}")
+        self.jsonl_path = jsonl_path
+        self.shards = shards
+        self.paths = shard_paths(jsonl_path, shards)
+        self.files = [open(path + '.tmp', 'w') for path in self.paths]
+        self.buffers = [[] for _ in range(shards)]
+        self.counts = [0] * shards
+
+    def write(self, third_party_id: str, line: str):
+        shard = shard_for_id(third_party_id, self.shards) if self.shards > 1 else 0
+        self.buffers[shard].append(line)
+        self.counts[shard] += 1
+
+    def flush(self):
+        for outfile, buffer in zip(self.files, self.buffers):
+            if buffer:
+                outfile.writelines(buffer)
+                buffer.clear()
+
+    def close(self):
+        self.flush()
+        for outfile in self.files:
+            outfile.close()
+        for path in self.paths:
+            os.replace(path + '.tmp', path)
+        manifest = {
+            "shards": self.shards,
+            "partition": "blake2b-64(ThirdPartyDataId) mod shards",
+            "records": sum(self.counts),
+            "files": [{"path": os.path.basename(path), "records": count}
+                      for path, count in zip(self.paths, self.counts)],
+        }
+        target = manifest_path(self.jsonl_path)
+        with open(target + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(target + '.tmp', target)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for outfile, path in zip(self.files, self.paths):
+                outfile.close()
+                os.remove(path + '.tmp')
+
+
+def read_manifest(jsonl_path: str) -> Optional[Dict]:
+    path = manifest_path(jsonl_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_shard(path: str, ids: Optional[frozenset] = None) -> Dict[str, Dict]:
+    records = {}
+    with open(path, 'r') as file:
+        for line in file:
+            data = json.loads(line)
+            if ids is None or data['ThirdPartyDataId'] in ids:
+                records[data['ThirdPartyDataId']] = data
+    return records
+
+
+def load_records(jsonl_path: str, ids: Optional[Iterable[str]] = None,
+                 workers: int = LOAD_WORKERS) -> Dict[str, Dict]:
+    """Load records keyed by ThirdPartyDataId, optionally only those in `ids`.
+
+    Only the shards that can hold one of `ids` are read. Shards are parsed in a
+    process pool when there is more than one to read.
+    """
+    manifest = read_manifest(jsonl_path)
+    if manifest is None:
+        paths = [jsonl_path]
+    else:
+        directory = os.path.dirname(jsonl_path)
+        paths = [os.path.join(directory, entry['path']) for entry in manifest['files']]
+
+    if ids is not None:
+        ids = frozenset(ids)
+        if manifest is not None and manifest['shards'] > 1:
+            needed = {shard_for_id(third_party_id, manifest['shards']) for third_party_id in ids}
+            paths = [path for shard, path in enumerate(paths) if shard in needed]
+
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        shard_records = [_load_shard(path, ids) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            shard_records = list(executor.map(_load_shard, paths, [ids] * len(paths)))
+
+    records = {}
+    for shard in shard_records:
+        records.update(shard)
+    return records
@@ -0,0 +1,75 @@
+import sqlite3
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+##############################################################################################
+# Local record of what is in the Pinecone index.
+# apply_pinecone_changes stores each applied id with the metadata_hash and embedding_hash
+# it wrote (see prepare_pinecone_jsonl), and removes deleted ids. detect_pinecone_changes
+# diffs pinecone_data.jsonl against this table without calling Pinecone. A reconcile
+# run compares against the index itself and corrects the table.
+##############################################################################################
+
+STATE_TABLE = 'pinecone_state'
+METADATA_HASH_KEY = 'metadata_hash'
+EMBEDDING_HASH_KEY = 'embedding_hash'
+
+
+def ensure_state_table(conn: sqlite3.Connection):
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            ThirdPartyDataId TEXT PRIMARY KEY,
+            MetadataHash TEXT,
+            EmbeddingHash TEXT,
+            UpdatedUTC TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+
+
+def load_state(conn: sqlite3.Connection) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    """ThirdPartyDataId -> (metadata hash, embedding hash) as last applied."""
+    ensure_state_table(conn)
+    cursor = conn.execute(f"SELECT ThirdPartyDataId, MetadataHash, EmbeddingHash FROM {STATE_TABLE}")
+    return {third_party_id: (metadata_hash, embedding_hash) for third_party_id, metadata_hash, embedding_hash in cursor}
+
+
+def record_upserts(conn: sqlite3.Connection, items: Iterable[Tuple[str, Dict]]):
+    """Store (id, record) pairs now in the index, with the record's hash keys (None if absent)."""
+    updated = datetime.utcnow().isoformat()
+    conn.executemany(f'''
+        INSERT INTO {STATE_TABLE} (ThirdPartyDataId, MetadataHash, EmbeddingHash, UpdatedUTC)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(ThirdPartyDataId) DO UPDATE SET
+            MetadataHash = excluded.MetadataHash,
+            EmbeddingHash = excluded.EmbeddingHash,
+            UpdatedUTC = excluded.UpdatedUTC
+    ''', [(third_party_id, record.get(METADATA_HASH_KEY), record.get(EMBEDDING_HASH_KEY), updated)
+          for third_party_id, record in items])
+    conn.commit()
+
+
+def record_deletes(conn: sqlite3.Connection, ids: Iterable[str]):
+    conn.executemany(f"DELETE FROM {STATE_TABLE} WHERE ThirdPartyDataId = ?", [(third_party_id,) for third_party_id in ids])
+    conn.commit()
+
+
+def diff_against_state(local_data: Dict[str, Dict],
+                       state: Dict[str, Tuple[Optional[str], Optional[str]]]) -> Iterator[Tuple[str, str, List[str]]]:
+    """Yield (id, action, different keys) for local records that differ from the state, then deletions.
+
+    Actions match detect_pinecone_changes.compare_data: "add", "update" (embedding text
+    changed), "update_metadata" and "delete".
+    """
+    for third_party_id, record in local_data.items():
+        applied = state.get(third_party_id)
+        if applied is None:
+            yield third_party_id, "add", ["all"]
+        elif applied[1] != record[EMBEDDING_HASH_KEY]:
+            yield third_party_id, "update", ["embedding"]
+        elif applied[0] != record[METADATA_HASH_KEY]:
+            yield third_party_id, "update_metadata", ["metadata"]
+
+    for third_party_id in state:
+        if third_party_id not in local_data:
+            yield third_party_id, "delete", ["all"]
@@ -1,86 +1,152 @@
 import sqlite3
 import json
+import hashlib
+import time
+import argparse
+from pinecone_jsonl import ShardedJsonlWriter
+from pinecone_state import EMBEDDING_HASH_KEY, METADATA_HASH_KEY
 
-def fetch_data(query, conn):
-    cursor = conn.cursor()
-    cursor.execute(query)
-    return cursor.fetchall()
+DB_PATH = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db'
+OUTPUT_PATH = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/jsonl/pinecone_data.jsonl'
+FETCH_ROWS = 10000
+_HASH_ENCODER = json.JSONEncoder(sort_keys=True)
+
+# Per-vertical ratios are computed in SQL. CAST ... AS REAL keeps SQLite from doing integer
+# division, and ELSE 0 gives the same integer 0 as the former Python expressions.
+SEGMENT_PERFORMANCE_QUERY = """
+    SELECT s.rowid,
+           {segment_columns},
+           p.ThirdPartyDataId IS NOT NULL,
+           p.Vertical,
+           p.total_clicks,
+           p.total_impressions,
+           p.total_hypothetical_cost,
+           p.total_click_view_conversions,
+           CASE WHEN p.total_impressions THEN CAST(p.total_clicks AS REAL) / p.total_impressions ELSE 0 END,
+           CASE WHEN p.total_click_view_conversions THEN CAST(p.total_hypothetical_cost AS REAL) / p.total_click_view_conversions ELSE 0 END,
+           CASE WHEN p.total_clicks THEN CAST(p.total_hypothetical_cost AS REAL) / p.total_clicks ELSE 0 END
+    FROM segments s
+    LEFT JOIN performance_summary p ON p.ThirdPartyDataId = s.ThirdPartyDataId
+    ORDER BY s.rowid, p.Vertical
+"""
+
+def calculate_performance_keys(performance_rows):
+    """Per-vertical and overall CTR/CPA/CPC keys for one segment's performance rows.
 
-def calculate_performance_keys(performance_data):
+    Per-vertical ratios arrive computed by SEGMENT_PERFORMANCE_QUERY. The overall sums
+    are still added up here in row order: SQLite's SUM() may use compensated summation,
+    which would change the last bits of the overall ratios.
+    """
     keys = {}
     overall_clicks = 0
     overall_impressions = 0
     overall_cost = 0
     overall_conversions = 0
-    
-    for row in performance_data:
-        vertical = row['Vertical']
-        total_clicks = row['total_clicks']
-        total_impressions = row['total_impressions']
-        total_hypothetical_cost = row['total_hypothetical_cost']
-        total_click_view_conversions = row['total_click_view_conversions']
-        
-        ctr = total_clicks / total_impressions if total_impressions else 0
-        cpa = total_hypothetical_cost / total_click_view_conversions if total_click_view_conversions else 0
-        cpc = total_hypothetical_cost / total_clicks if total_clicks else 0
-        
+
+    for vertical, total_clicks, total_impressions, total_hypothetical_cost, total_click_view_conversions, ctr, cpa, cpc in performance_rows:
         keys[f'{vertical}_ctr'] = ctr
         keys[f'{vertical}_cpa'] = cpa
         keys[f'{vertical}_cpc'] = cpc
-        
+
         overall_clicks += total_clicks
         overall_impressions += total_impressions
         overall_cost += total_hypothetical_cost
         overall_conversions += total_click_view_conversions
-    
-    overall_ctr = overall_clicks / overall_impressions if overall_impressions else 0
-    overall_cpa = overall_cost / overall_conversions if overall_conversions else 0
-    overall_cpc = overall_cost / overall_clicks if overall_clicks else 0
-    
-    keys['overall_ctr'] = overall_ctr
-    keys['overall_cpa'] = overall_cpa
-    keys['overall_cpc'] = overall_cpc
-    
+
+    keys['overall_ctr'] = overall_clicks / overall_impressions if overall_impressions else 0
+    keys['overall_cpa'] = overall_cost / overall_conversions if overall_conversions else 0
+    keys['overall_cpc'] = overall_cost / overall_clicks if overall_clicks else 0
+
     return keys
 
+def iter_segment_records(conn, fetch_rows=FETCH_ROWS):
+    """Yield one dict per segment with its performance keys, streaming a single joined query.
+
+    Segments come out in table order and their performance rows in (ThirdPartyDataId,
+    Vertical) order, as with the former per-table fetchall() and Python grouping.
+    """
+    segment_columns = [row[1] for row in conn.execute("PRAGMA table_info(segments)") if row[1] != '_content_hash']
+    if 'ThirdPartyDataId' not in segment_columns:
+        raise sqlite3.OperationalError("segments has no ThirdPartyDataId column")
+    select_columns = ', '.join([f's."{col}"' for col in segment_columns])
+    width = len(segment_columns)
+
+    cursor = conn.cursor()
+    cursor.execute(SEGMENT_PERFORMANCE_QUERY.format(segment_columns=select_columns))
+    current_rowid = None
+    segment = None
+    performance_rows = []
+    while True:
+        block = cursor.fetchmany(fetch_rows)
+        if not block:
+            break
+        for row in block:
+            if row[0] != current_rowid:
+                if segment is not None:
+                    yield build_record(segment_columns, segment, performance_rows)
+                current_rowid = row[0]
+                segment = row[1:width + 1]
+                performance_rows = []
+            if row[width + 1]:  # Matched a performance_summary row
+                performance_rows.append(row[width + 2:])
+    if segment is not None:
+        yield build_record(segment_columns, segment, performance_rows)
+
+def build_record(segment_columns, segment, performance_rows):
+    segment_dict = dict(zip(segment_columns, segment))
+    if performance_rows:
+        segment_dict.update(calculate_performance_keys(performance_rows))
+    return segment_dict
+
 def replace_none_with_null(d):
     return {k: ("null" if v is None else v) for k, v in d.items()}
 
-def main():
+def embedding_text(record):
+    """The text that gets embedded; must match apply_pinecone_changes.generate_embeddings."""
+    return f"Full Path: {record['FullPath']}, Description: {record['Description']}"
+
+def content_hash(value):
+    return hashlib.blake2b(_HASH_ENCODER.encode(value).encode(), digest_size=16).hexdigest()
+
+def add_fingerprints(record):
+    """Add hashes of the metadata and of the embedding text, so changes can be detected by comparing them.
+
+    They are stored in Pinecone metadata with the rest of the record. A changed embedding
+    hash means the vector must be re-embedded; a changed metadata hash alone does not.
+    """
+    metadata = {k: v for k, v in record.items() if k != 'ThirdPartyDataId'}
+    record[METADATA_HASH_KEY] = content_hash(metadata)
+    record[EMBEDDING_HASH_KEY] = content_hash(embedding_text(record))
+    return record
+
+def main(db_path=DB_PATH, output_path=OUTPUT_PATH, shards=1):
     try:
-        conn = sqlite3.connect('/Users/adamhunter/Documents/3rd_party_element_pipeline/data/sql/element_performance.db')
-        conn.row_factory = sqlite3.Row
-        
-        segments_query = "SELECT * FROM segments"
-        performance_query = "SELECT * FROM performance_summary"
-        
-        segments_data = fetch_data(segments_query, conn)
-        performance_data = fetch_data(performance_query, conn)
-        
-        # Group performance data by ThirdPartyDataId
-        performance_dict = {}
-        for row in performance_data:
-            third_party_id = row['ThirdPartyDataId']
-            if third_party_id not in performance_dict:
-                performance_dict[third_party_id] = []
-            performance_dict[third_party_id].append(row)
-        
-        with open('/Users/adamhunter/Documents/3rd_party_element_pipeline/data/jsonl/pinecone_data.jsonl', 'w') as outfile:
-            for segment in segments_data:
-                third_party_id = segment['ThirdPartyDataId']
-                segment_dict = dict(segment)  # Convert sqlite3.Row to dictionary
-                if third_party_id in performance_dict:
-                    performance_keys = calculate_performance_keys(performance_dict[third_party_id])
-                    segment_dict.update(performance_keys)
+        conn = sqlite3.connect(db_path)
+        started = time.perf_counter()
+        written = 0
+
+        # json.dumps runs in the C encoder; json.dump would build each line in Python, piece by piece
+        with ShardedJsonlWriter(output_path, shards) as writer:
+            for segment_dict in iter_segment_records(conn):
                 segment_dict = replace_none_with_null(segment_dict)  # Replace None with "null"
-                json.dump(segment_dict, outfile)
-                outfile.write('\n')
-        
+                add_fingerprints(segment_dict)
+                writer.write(segment_dict['ThirdPartyDataId'], json.dumps(segment_dict) + '\n')
+                written += 1
+                if written % FETCH_ROWS == 0:
+                    writer.flush()
+
         conn.close()
+        elapsed = time.perf_counter() - started
+        print(f"Wrote {written} records to {output_path} ({shards} shard{'s' if shards > 1 else ''}) in {elapsed:.1f}s "
+              f"({written / max(elapsed, 1e-9):,.0f} records/sec)")
     except sqlite3.OperationalError as e:
         print(f"SQLite error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepare the Pinecone JSONL from element_performance.db")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of hash-partitioned output files, listed in a manifest next to the output path")
+    args = parser.parse_args()
+    main(shards=args.shards)
@@ -1,5 +1,4 @@
 import pandas as pd
-import requests
 import json
 import os
 import time
@@ -7,9 +6,13 @@ import logging
 from typing import Dict, Any, List, Set
 from dotenv import load_dotenv
 from requests.exceptions import RequestException
+from ttd_client import get_client
 from datetime import datetime
 import random
 import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 ##############################################################################################
 # This script takes any valid pathlabs advertiser id as input, downloads all available brands,     
@@ -23,37 +26,18 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Load environment variables
 load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
 
-TTD_USERNAME = os.getenv('TTD_USERNAME')
-TTD_PASS = os.getenv('TTD_PASS')
 PARTNER_ID = os.getenv('PARTNER_ID')
 
-def get_auth_token(max_retries=3, retry_delay=5) -> str:
-    """Get authentication token from The Trade Desk API with retries."""
-    url = "https://api.thetradedesk.com/v3/authentication"
-    payload = {"Login": TTD_USERNAME, "Password": TTD_PASS}
-    headers = {"Content-Type": "application/json"}
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            return response.json().get("Token")
-        except RequestException as e:
-            if attempt == max_retries - 1:
-                logging.error(f"Failed to get auth token after {max_retries} attempts: {e}")
-                raise
-            logging.warning(f"Auth token request failed. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-
-
-def get_all_advertiser_ids(token: str, partner_id: str) -> Set[str]:
+# DMP crawl tuning
+DMP_BATCH_SIZE = 10
+DMP_MAX_WORKERS = int(os.getenv('DMP_MAX_WORKERS', 8))
+DMP_REQUESTS_PER_SECOND = float(os.getenv('DMP_REQUESTS_PER_SECOND', 4))
+DMP_PAGES_AHEAD = 2
+
+def get_all_advertiser_ids(partner_id: str) -> Set[str]:
     """Retrieve all advertiser IDs."""
-    url = f"https://api.thetradedesk.com/v3/overview/partner/{partner_id}"
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
-    
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        response = get_client().get(f"overview/partner/{partner_id}")
         partner_overview = response.json()
         
         all_advertiser_ids = set()
@@ -65,29 +49,83 @@ def get_all_advertiser_ids(token: str, partner_id: str) -> Set[str]:
         logging.error(f"Failed to get advertiser IDs: {e}")
         raise
 
-def get_available_brands(advertiser_id: str, token: str, max_retries=3, retry_delay=5) -> List[str]:
+def get_available_brands(advertiser_id: str) -> List[str]:
     """Get available brand IDs for a given advertiser."""
-    url = f"https://api.thetradedesk.com/v3/dmp/thirdparty/facets/{advertiser_id}"
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, headers=headers)
-            print(json.dumps(response.json(), indent=2))
-            response.raise_for_status()
-            brands = response.json().get("Brands", [])
-            return [brand["BrandId"] for brand in brands]
-        except RequestException as e:
-            if attempt == max_retries - 1:
-                logging.error(f"Failed to get available brands after {max_retries} attempts: {e}")
-                raise
-            logging.warning(f"Brand retrieval failed. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-
-def query_third_party_data(advertiser_id: str, token: str, brand_ids: List[str], page_start_index: int = 0, page_size: int = 100, max_retries=3, retry_delay=10) -> Dict[str, Any]:
+    response = get_client().get(f"dmp/thirdparty/facets/{advertiser_id}")
+    print(json.dumps(response.json(), indent=2))
+    brands = response.json().get("Brands", [])
+    return [brand["BrandId"] for brand in brands]
+
+class TokenBucket:
+    """Thread-safe token bucket shared by all DMP request threads."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class AdaptiveLimits:
+    """Adjusts page size and concurrency from observed request latency."""
+
+    def __init__(self, page_size=1000, min_page_size=100, max_page_size=1000,
+                 concurrency=4, max_concurrency=8, slow_seconds=30.0, fast_seconds=5.0):
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.slow_seconds = slow_seconds
+        self.fast_seconds = fast_seconds
+        self.avg_latency = None
+        self.lock = threading.Lock()
+
+    def record_latency(self, seconds: float):
+        with self.lock:
+            if self.avg_latency is None:
+                self.avg_latency = seconds
+            else:
+                self.avg_latency = 0.8 * self.avg_latency + 0.2 * seconds
+
+            if self.avg_latency > self.slow_seconds:
+                self.page_size = max(self.min_page_size, self.page_size // 2)
+                self.concurrency = max(1, self.concurrency - 1)
+            elif self.avg_latency < self.fast_seconds:
+                self.page_size = min(self.max_page_size, self.page_size * 2)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def record_throttle(self):
+        with self.lock:
+            self.concurrency = max(1, self.concurrency // 2)
+
+
+def query_third_party_data(advertiser_id: str, brand_ids: List[str], page_start_index: int = 0, page_size: int = 100, limiter: TokenBucket = None, limits: AdaptiveLimits = None) -> Dict[str, Any]:
     """Query third-party data from The Trade Desk API with retries."""
-    url = "https://api.thetradedesk.com/v3/dmp/thirdparty/advertiser"
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
     payload = {
         "AdvertiserId": advertiser_id,
         "PageStartIndex": page_start_index,
@@ -96,48 +134,262 @@ def query_third_party_data(advertiser_id: str, token: str, brand_ids: List[str],
         "UniqueCountMinimum": 0,
         "ExcludeTotalCounts": True
     }
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=payload, timeout=600)
-            response.raise_for_status()
-            return response.json()
-        except RequestException as e:
-            if attempt == max_retries - 1:
-                logging.error(f"Failed to query third-party data after {max_retries} attempts: {e}")
-                raise
-            if response.status_code == 429:  # Too Many Requests
-                retry_delay = int(response.headers.get('Retry-After', retry_delay))
-            logging.warning(f"Query failed. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-
-def fetch_all_third_party_data(advertiser_id: str, token: str, brand_ids: List[str], output_file: str):
-    """Fetch all third-party data for an advertiser and save to file."""
-    page_size = 1000
-    page_start_index = 0
-    
-    with open(output_file, 'a') as f:  # Changed to append mode
-        while True:
-            try:
-                result = query_third_party_data(advertiser_id, token, brand_ids, page_start_index, page_size)
-                print(len(result['Result']))
-                if 'Result' not in result or not result['Result']:
-                    break
-                
-                for item in result['Result']:
+    response = get_client().post("dmp/thirdparty/advertiser", json=payload, limiter=limiter,
+                                 on_throttle=limits.record_throttle if limits else None)
+    return response.json()
+
+
+class BatchState:
+    """Paging progress for one brand batch."""
+
+    def __init__(self, batch_number: int, brand_ids: List[str]):
+        self.batch_number = batch_number
+        self.brand_ids = brand_ids
+        self.next_start = 0
+        self.end_index = None  # Set once a short or empty page is seen
+        self.covered = []  # (start, stop) index ranges already written to the output file
+        self.in_flight = 0
+        self.failed = False
+
+    @property
+    def key(self) -> str:
+        return ','.join(self.brand_ids)
+
+    @property
+    def finished(self) -> bool:
+        return (self.failed or self.end_index is not None) and self.in_flight == 0
+
+    def is_covered(self, index: int) -> bool:
+        return any(start <= index < stop for start, stop in self.covered)
+
+    def contiguous_end(self) -> int:
+        """End of the range written without gaps, starting from index 0."""
+        end = 0
+        for start, stop in sorted(self.covered):
+            if start > end:
+                break
+            end = max(end, stop)
+        return end
+
+    @property
+    def complete(self) -> bool:
+        return self.end_index is not None and self.contiguous_end() >= self.end_index
+
+
+class CrawlCheckpoint:
+    """Append-only ledger of completed pages, kept next to the DMP output file.
+
+    The first line records the advertiser and brand batches of the run; every following
+    line records one page (brand batch, PageStartIndex, item count) together with the
+    output file size after it was written. On restart the output file is truncated back
+    to the last recorded size, so a page is either fully written and recorded or not
+    present at all.
+    """
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.path = f"{output_file}.checkpoint"
+        self.advertiser_id = None
+        self.brand_batches = None
+        self.pages = {}  # batch key -> list of (page_start_index, count, page_size)
+        self.failed = set()
+        self.offset = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Partially written last line
+                if entry['type'] == 'run':
+                    self.advertiser_id = entry['AdvertiserId']
+                    self.brand_batches = entry['BrandBatches']
+                elif entry['type'] == 'page':
+                    self.pages.setdefault(entry['Batch'], []).append(
+                        (entry['PageStartIndex'], entry['Count'], entry['PageSize']))
+                    self.failed.discard(entry['Batch'])
+                    self.offset = entry['Offset']
+                elif entry['type'] == 'failed':
+                    self.failed.add(entry['Batch'])
+
+    @property
+    def exists(self) -> bool:
+        return self.brand_batches is not None
+
+    def start(self, advertiser_id: str, brand_batches: List[List[str]]):
+        self.advertiser_id = advertiser_id
+        self.brand_batches = brand_batches
+        self._append({"type": "run", "AdvertiserId": advertiser_id, "BrandBatches": brand_batches})
+
+    def truncate_output(self):
+        """Drop output lines written after the last recorded page."""
+        if os.path.exists(self.output_file) and os.path.getsize(self.output_file) > self.offset:
+            logging.warning(f"Truncating {self.output_file} to last checkpoint at byte {self.offset}")
+            with open(self.output_file, 'r+') as f:
+                f.truncate(self.offset)
+
+    def restore(self, batch: BatchState):
+        for page_start_index, count, page_size in self.pages.get(batch.key, []):
+            if count:
+                batch.covered.append((page_start_index, page_start_index + count))
+            if count < page_size:
+                end_index = page_start_index + count
+                if batch.end_index is None or end_index < batch.end_index:
+                    batch.end_index = end_index
+        batch.next_start = batch.contiguous_end()
+        if not batch.complete:
+            batch.end_index = None  # Still has a gap to fill
+
+    def record_page(self, batch: BatchState, page_start_index: int, count: int, page_size: int, offset: int):
+        self.pages.setdefault(batch.key, []).append((page_start_index, count, page_size))
+        self.offset = offset
+        self._append({"type": "page", "Batch": batch.key, "PageStartIndex": page_start_index,
+                      "Count": count, "PageSize": page_size, "Offset": offset})
+
+    def record_failure(self, batch: BatchState):
+        self.failed.add(batch.key)
+        self._append({"type": "failed", "Batch": batch.key})
+
+    def incomplete_batches(self) -> List[int]:
+        """Return the 1-based numbers of batches that have not been fully fetched."""
+        incomplete = []
+        for i, brand_ids in enumerate(self.brand_batches or []):
+            batch = BatchState(i + 1, brand_ids)
+            self.restore(batch)
+            if not batch.complete:
+                incomplete.append(batch.batch_number)
+        return incomplete
+
+    def summary(self) -> str:
+        incomplete = self.incomplete_batches()
+        total = len(self.brand_batches or [])
+        lines = [f"{total - len(incomplete)}/{total} brand batches complete"]
+        for batch_number in incomplete:
+            brand_ids = self.brand_batches[batch_number - 1]
+            key = ','.join(brand_ids)
+            fetched = sum(count for _, count, _ in self.pages.get(key, []))
+            state = "failed" if key in self.failed else "not finished"
+            lines.append(f"  batch {batch_number} ({state}, {fetched} items fetched): {key}")
+        return '\n'.join(lines)
+
+    def remove(self):
+        """Delete the ledger once its crawl is complete, so a later run cannot resume from it."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _append(self, entry: Dict[str, Any]):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _fetch_page(advertiser_id, batch, page_start_index, page_size, limiter, limits):
+    started = time.monotonic()
+    result = query_third_party_data(advertiser_id, batch.brand_ids, page_start_index, page_size,
+                                    limiter=limiter, limits=limits)
+    limits.record_latency(time.monotonic() - started)
+    return result.get('Result') or []
+
+
+def fetch_all_third_party_data(advertiser_id: str, brand_batches: List[List[str]], output_file: str,
+                               max_workers=DMP_MAX_WORKERS, requests_per_second=DMP_REQUESTS_PER_SECOND,
+                               pages_ahead=DMP_PAGES_AHEAD, checkpoint: CrawlCheckpoint = None):
+    """Fetch all third-party data for the given brand batches concurrently and append it to file.
+
+    Several batches, and up to `pages_ahead` pages of each batch, are requested at once. All
+    requests share one token bucket; page size and the number of requests in flight follow
+    the observed latency. With a checkpoint, pages already recorded are skipped and every
+    written page is recorded, so an interrupted crawl can be resumed without duplicates.
+    """
+    limiter = TokenBucket(requests_per_second, capacity=max(1, int(requests_per_second)))
+    limits = AdaptiveLimits(max_concurrency=max_workers, concurrency=min(4, max_workers))
+    batches = [BatchState(i + 1, brand_ids) for i, brand_ids in enumerate(brand_batches)]
+    if checkpoint:
+        checkpoint.truncate_output()
+        for batch in batches:
+            checkpoint.restore(batch)
+        skipped = [batch for batch in batches if batch.complete]
+        if skipped:
+            logging.info(f"Skipping {len(skipped)} brand batches already completed in {checkpoint.path}")
+        batches = [batch for batch in batches if not batch.complete]
+    pending = deque(batches)
+    futures = {}
+    total_items = 0
+
+    def schedule(executor):
+        # Round-robin over batches, one page each per pass so every batch makes progress, until
+        # each has `pages_ahead` pages in flight or the concurrency limit is reached
+        submitted = True
+        while submitted:
+            submitted = False
+            for _ in range(len(pending)):
+                if len(futures) >= limits.concurrency:
+                    return
+                batch = pending[0]
+                pending.rotate(-1)
+                if batch.failed or batch.end_index is not None or batch.in_flight >= pages_ahead:
+                    continue
+                page_size = limits.page_size
+                future = executor.submit(_fetch_page, advertiser_id, batch, batch.next_start,
+                                         page_size, limiter, limits)
+                futures[future] = (batch, batch.next_start, page_size)
+                batch.next_start += page_size
+                batch.in_flight += 1
+                submitted = True
+
+    with open(output_file, 'a') as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        schedule(executor)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch, page_start_index, page_size = futures.pop(future)
+                batch.in_flight -= 1
+                try:
+                    items = future.result()
+                except Exception as e:
+                    logging.error(f"Error fetching batch {batch.batch_number} at index {page_start_index} for AdvertiserId {advertiser_id}: {e}")
+                    if not batch.failed and checkpoint:
+                        checkpoint.record_failure(batch)
+                    batch.failed = True
+                    if batch.finished:
+                        pending.remove(batch)
+                    continue
+
+                written = 0
+                for i, item in enumerate(items):
+                    if batch.is_covered(page_start_index + i):
+                        continue  # Already written before a restart
                     json.dump(item, f)
                     f.write('\n')
-                
-                page_start_index += len(result['Result'])
-                logging.info(f"Fetched {page_start_index} results for AdvertiserId: {advertiser_id}")
-                
-                if len(result['Result']) < page_size:
-                    break
-                
-                time.sleep(1)  # Rate limiting
-            except Exception as e:
-                logging.error(f"Error fetching data for AdvertiserId {advertiser_id}: {e}")
-                break
+                    written += 1
+                total_items += written
+
+                if items:
+                    batch.covered.append((page_start_index, page_start_index + len(items)))
+                if len(items) < page_size:
+                    end_index = page_start_index + len(items)
+                    if batch.end_index is None or end_index < batch.end_index:
+                        batch.end_index = end_index
+                if checkpoint:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    checkpoint.record_page(batch, page_start_index, len(items), page_size, f.tell())
+                logging.info(f"Fetched {len(items)} results at index {page_start_index} for batch {batch.batch_number} ({total_items} total)")
+
+                if batch.finished:
+                    pending.remove(batch)
+                    if batch.failed:
+                        logging.error(f"Batch {batch.batch_number} for AdvertiserId {advertiser_id} did not complete")
+                    else:
+                        logging.info(f"Completed batch {batch.batch_number} for AdvertiserId: {advertiser_id}")
+            schedule(executor)
+
+    return total_items
 
 if __name__ == "__main__":
     # Set up output directory
@@ -148,42 +400,53 @@ if __name__ == "__main__":
     timestamp = datetime.now().strftime("%Y-%m-%d")
     output_file = os.path.join(output_dir, f'3rd_party_dmp_{timestamp}.jsonl')
 
-    # Check if file already exists
-    if os.path.exists(output_file):
-        error_message = f"Error: File '{output_file}' already exists for today's date. Please remove or rename the existing file before running the script again."
+    # Resume from the checkpoint ledger if an earlier run today was interrupted
+    checkpoint = CrawlCheckpoint(output_file)
+    if checkpoint.exists and not checkpoint.incomplete_batches():
+        logging.info(f"All brand batches in '{output_file}' are already complete. Nothing to do.")
+        checkpoint.remove()
+        sys.exit(0)
+    if os.path.exists(output_file) and not checkpoint.exists:
+        error_message = f"Error: File '{output_file}' already exists for today's date and has no checkpoint to resume from. Please remove or rename the existing file before running the script again."
         logging.error(error_message)
         print(error_message, file=sys.stderr)
         sys.exit(1)
 
-    # Get authentication token
-    token = get_auth_token()
-
-    # Get all advertiser IDs
-    try:
-        all_advertiser_ids = get_all_advertiser_ids(token, PARTNER_ID)
-        logging.info(f"Retrieved {len(all_advertiser_ids)} advertiser IDs")
-
-        # Randomly select an advertiser ID, it doesnt seem to matter which
-        if all_advertiser_ids:
-            advertiser_id = random.choice(list(all_advertiser_ids))
-            logging.info(f"Selected random AdvertiserId: {advertiser_id}")
-        else:
-            logging.error("No advertiser IDs found")
-            exit(1)
-    except Exception as e:
-        logging.error(f"Failed to retrieve advertiser IDs: {e}")
-        exit(1)
-    available_brands = get_available_brands(advertiser_id, token)
-    logging.info(f"Retrieved {len(available_brands)} available brands for AdvertiserId: {advertiser_id}")
-
-    # Process brand IDs in batches of 10
-    for i in range(0, len(available_brands), 10):
-        brand_id_batch = available_brands[i:i+10]
+    if checkpoint.exists:
+        advertiser_id = checkpoint.advertiser_id
+        brand_batches = checkpoint.brand_batches
+        logging.info(f"Resuming AdvertiserId {advertiser_id} from {checkpoint.path}")
+    else:
+        # Get all advertiser IDs
         try:
-            fetch_all_third_party_data(advertiser_id, token, brand_id_batch, output_file)
-            logging.info(f"Completed batch {i//10 + 1} for AdvertiserId: {advertiser_id}")
+            all_advertiser_ids = get_all_advertiser_ids(PARTNER_ID)
+            logging.info(f"Retrieved {len(all_advertiser_ids)} advertiser IDs")
+
+            # Randomly select an advertiser ID, it doesnt seem to matter which
+            if all_advertiser_ids:
+                advertiser_id = random.choice(list(all_advertiser_ids))
+                logging.info(f"Selected random AdvertiserId: {advertiser_id}")
+            else:
+                logging.error("No advertiser IDs found")
+                exit(1)
         except Exception as e:
-            logging.error(f"Error processing batch {i//10 + 1} for AdvertiserId {advertiser_id}: {e}")
-        time.sleep(2)  # Add a delay between batches
+            logging.error(f"Failed to retrieve advertiser IDs: {e}")
+            exit(1)
+        available_brands = get_available_brands(advertiser_id)
+        logging.info(f"Retrieved {len(available_brands)} available brands for AdvertiserId: {advertiser_id}")
+
+        # Process brand IDs in batches of 10, several batches at a time
+        brand_batches = [available_brands[i:i+DMP_BATCH_SIZE] for i in range(0, len(available_brands), DMP_BATCH_SIZE)]
+        checkpoint.start(advertiser_id, brand_batches)
+
+    total_items = fetch_all_third_party_data(advertiser_id, brand_batches, output_file, checkpoint=checkpoint)
+    logging.info(f"Fetched {total_items} segments across {len(brand_batches)} brand batches")
+    logging.info(f"Checkpoint summary:\n{checkpoint.summary()}")
+    get_client().log_stats()
+
+    if checkpoint.incomplete_batches():
+        logging.error(f"Some brand batches are incomplete. Re-run to resume from {checkpoint.path}")
+        sys.exit(1)
 
-    logging.info(f"Completed AdvertiserId: {advertiser_id}. Data saved to {output_file}")
\ No newline at end of file
+    checkpoint.remove()
+    logging.info(f"Completed AdvertiserId: {advertiser_id}. Data saved to {output_file}")
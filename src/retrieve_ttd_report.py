@@ -1,46 +1,53 @@
 import requests
+import urllib3
 import json
 import os
+import gzip
+import shutil
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import logging
-import time
-from requests.exceptions import RequestException
-from query_dmp import get_auth_token
+from ttd_client import get_client
 import csv
 
 # Load environment variables
 load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
 
-TTD_USERNAME = os.getenv('TTD_USERNAME')
-TTD_PASS = os.getenv('TTD_PASS')
 PARTNER_ID = os.getenv('PARTNER_ID')
 DOWNLOAD_DIR = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/ai_element_performance/'
+MANIFEST_PATH = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/csv/ai_element_performance_manifest.json'
+# concatenate_ttd_reports.py archives each downloaded CSV here as Parquet and deletes the CSV
+COLUMNAR_DIR = '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/parquet/ai_element_performance/'
+BACKFILL_DAYS = 30 * 6  # Matches the report_stack window in concatenate_ttd_reports.py
+BACKFILL_WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
 
 
-def get_available_reports(token: str, partner_id: str, start_date: str, max_retries=3, retry_delay=5):
-    """Retrieve available reports for a given partner ID."""
-    url = "https://api.thetradedesk.com/v3/myreports/reportexecution/query/partners"
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
+def get_available_reports(partner_id: str, start_date: str, page_size=1000):
+    """Retrieve all available reports for a given partner ID, following pagination."""
     payload = {
         "PartnerIds": [partner_id],
         "ExecutionStates": ["Complete"],
         "ExecutionSpansStartDate": start_date,
         "PageStartIndex": 0,
-        "PageSize": 1000  # Adjust as needed
+        "PageSize": page_size
     }
     
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            if attempt == max_retries - 1:
-                print(f"Failed to get available reports after {max_retries} attempts: {e}")
-                raise
-            print(f"Report retrieval failed. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
+    results = []
+    while True:
+        response = get_client().post("myreports/reportexecution/query/partners", json=payload)
+        page = response.json()
+        page_results = page.get('Result') or []
+        results.extend(page_results)
+        total = page.get('ResultCount')
+        if len(page_results) < page_size or (total is not None and len(results) >= total):
+            break
+        payload["PageStartIndex"] += len(page_results)
+    return {"Result": results, "ResultCount": len(results)}
 
 def flatten_report(report):
     """Flatten a report object into a dictionary."""
@@ -67,47 +74,219 @@ def flatten_report(report):
     
     return flat_report
 
-def download_report(url: str, filename: str, max_retries=3, retry_delay=5):
-    """Download a report from the given URL."""
-    headers = {"Content-Type": "application/json", "TTD-Auth": token}
-    
+def _read_part_info(info_path: str) -> dict:
+    try:
+        with open(info_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _is_gzip(path: str, content_encoding: str) -> bool:
+    if content_encoding and 'gzip' in content_encoding.lower():
+        return True
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def download_report(url: str, filename: str, max_retries=5, chunk_size=CHUNK_SIZE):
+    """Stream a report from the given URL to disk.
+
+    Bytes go to `<filename>.part` as they arrive. If that file already exists the download
+    resumes with an HTTP Range request (guarded by If-Range on the ETag seen before), and a
+    dropped connection resumes the same way. Gzip-compressed deliveries are decompressed
+    once the download is complete, and the finished file is moved into place atomically.
+    """
+    client = get_client()
+    part_path = f"{filename}.part"
+    info_path = f"{part_path}.json"
+
     for attempt in range(max_retries):
+        info = _read_part_info(info_path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Take the raw bytes off the wire so Range offsets match what is on disk
+        headers = {"Accept-Encoding": "gzip"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if info.get("ETag"):
+                headers["If-Range"] = info["ETag"]
+
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            with open(filename, 'wb') as f:
-                f.write(response.content)
-            print(f"Report downloaded successfully: {filename}")
-            return True
-        except requests.RequestException as e:
+            with client.get(url, headers=headers, stream=True) as response:
+                if offset and response.status_code == 206:
+                    print(f"Resuming download of {filename} at byte {offset}")
+                    mode = 'ab'
+                else:
+                    mode = 'wb'  # Full response, the server ignored or rejected the Range
+                    info = {"ETag": response.headers.get('ETag'),
+                            "ContentEncoding": response.headers.get('Content-Encoding')}
+                    with open(info_path, 'w') as f:
+                        json.dump(info, f)
+
+                with open(part_path, mode) as f:
+                    for chunk in response.raw.stream(chunk_size, decode_content=False):
+                        f.write(chunk)
+                        client.count_received(len(chunk))
+            break
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 416 and offset:
+                break  # Nothing left past our offset, the part file is complete
+            print(f"Failed to download report: {e}")
+            return False
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
             if attempt == max_retries - 1:
                 print(f"Failed to download report after {max_retries} attempts: {e}")
                 return False
-            print(f"Download failed. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
+            print(f"Download interrupted ({e}). Resuming...")
 
-if __name__ == "__main__":
-    # Get authentication token
-    token = get_auth_token()
+    if _is_gzip(part_path, info.get("ContentEncoding")):
+        tmp_path = f"{filename}.tmp"
+        with gzip.open(part_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, chunk_size)
+        os.replace(tmp_path, filename)
+        os.remove(part_path)
+    else:
+        os.replace(part_path, filename)
+    if os.path.exists(info_path):
+        os.remove(info_path)
+
+    print(f"Report downloaded successfully: {filename}")
+    return True
+
+def get_element_performance_reports(reports):
+    """Filter reports with name containing 'ai_element_performance'."""
+    return [report for report in reports.get('Result', []) if 'ai_element_performance' in report['ReportScheduleName'].lower()]
+
+def report_filename(report):
+    """Local path for a report, named by schedule, end date and start date.
+
+    The end date stays right after the schedule name, where concatenate_ttd_reports reads
+    it; the start date keeps executions that end on the same day apart.
+    """
+    report_name = report['ReportScheduleName'].replace(' ', '_')
+    report_date = report['ReportEndDateExclusive'].split('T')[0]
+    start_date = report['ReportStartDateInclusive'].split('T')[0]
+    return os.path.join(DOWNLOAD_DIR, f"{report_name}_{report_date}_from_{start_date}.csv")
+
+def legacy_report_filename(report):
+    """Path used before the start date was part of the name."""
+    report_name = report['ReportScheduleName'].replace(' ', '_')
+    report_date = report['ReportEndDateExclusive'].split('T')[0]
+    return os.path.join(DOWNLOAD_DIR, f"{report_name}_{report_date}.csv")
+
+def report_on_disk(filename):
+    """Whether a report file, or its Parquet archive copy, exists."""
+    parquet_name = os.path.splitext(os.path.basename(filename))[0] + '.parquet'
+    return os.path.exists(filename) or os.path.exists(os.path.join(COLUMNAR_DIR, parquet_name))
+
+def load_manifest(path=None):
+    """Load the manifest of downloaded reports, keyed by ReportExecutionId."""
+    path = path or MANIFEST_PATH
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(manifest, path=None):
+    path = path or MANIFEST_PATH
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
 
+def record_download(manifest, report, filename):
+    manifest[str(report['ReportExecutionId'])] = {
+        "ReportScheduleName": report['ReportScheduleName'],
+        "ReportStartDateInclusive": report['ReportStartDateInclusive'],
+        "ReportEndDateExclusive": report['ReportEndDateExclusive'],
+        "LastStateChangeUTC": report['LastStateChangeUTC'],
+        "File": os.path.basename(filename),
+        "DownloadedUTC": datetime.utcnow().isoformat()
+    }
+
+def find_missing_reports(reports, manifest):
+    """Return the reports whose date range has no downloaded file yet.
+
+    When several executions cover the same date range only the most recent one is kept.
+    Files already on disk that predate the manifest are recorded in it instead of being
+    downloaded again. A file under the legacy name (no start date) is only taken to be a
+    report's when no other date range shares that name.
+    """
+    latest_by_range = {}
+    for report in reports:
+        date_range = (report['ReportScheduleName'], report['ReportStartDateInclusive'], report['ReportEndDateExclusive'])
+        current = latest_by_range.get(date_range)
+        if current is None or report['LastStateChangeUTC'] > current['LastStateChangeUTC']:
+            latest_by_range[date_range] = report
+
+    downloaded_ranges = {
+        (entry['ReportScheduleName'], entry['ReportStartDateInclusive'], entry['ReportEndDateExclusive'])
+        for entry in manifest.values()
+        if report_on_disk(os.path.join(DOWNLOAD_DIR, entry['File']))
+    }
+
+    legacy_names = {}
+    for report in latest_by_range.values():
+        legacy_names.setdefault(legacy_report_filename(report), []).append(report)
+
+    missing = []
+    for date_range, report in sorted(latest_by_range.items(), key=lambda item: item[0][2]):
+        if date_range in downloaded_ranges:
+            continue
+        filename = report_filename(report)
+        legacy_filename = legacy_report_filename(report)
+        if report_on_disk(filename):
+            record_download(manifest, report, filename)
+            continue
+        if report_on_disk(legacy_filename) and len(legacy_names[legacy_filename]) == 1:
+            record_download(manifest, report, legacy_filename)
+            continue
+        missing.append(report)
+    return missing
+
+def backfill_reports(days=BACKFILL_DAYS, max_workers=BACKFILL_WORKERS):
+    """Download every completed report in the window that is not already on disk."""
+    start_date = (datetime.now() - timedelta(days=days)).isoformat()
+    reports = get_element_performance_reports(get_available_reports(PARTNER_ID, start_date))
+    print(f"Found {len(reports)} completed 'ai_element_performance' reports since {start_date}")
+
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    manifest = load_manifest()
+    missing = [report for report in find_missing_reports(reports, manifest) if report['ReportDeliveries']]
+    save_manifest(manifest)
+    print(f"{len(missing)} reports missing from {DOWNLOAD_DIR}")
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_report = {
+            executor.submit(download_report, report['ReportDeliveries'][0]['DownloadURL'], report_filename(report)): report
+            for report in missing
+        }
+        for future in as_completed(future_to_report):
+            report = future_to_report[future]
+            if future.result():
+                record_download(manifest, report, report_filename(report))
+                save_manifest(manifest)
+            else:
+                failed.append(report['ReportExecutionId'])
+
+    print(f"Backfilled {len(missing) - len(failed)} reports, {len(failed)} failed")
+    return failed
+
+def download_most_recent_report():
     # Set the start date for report retrieval (e.g., 30 days ago)
     start_date = (datetime.now() - timedelta(days=30)).isoformat()
 
     # Get available reports
-    reports = get_available_reports(token, PARTNER_ID, start_date)
+    reports = get_available_reports(PARTNER_ID, start_date)
 
     if reports and 'Result' in reports:
-        # Filter reports with name containing 'element_performance'
-        element_performance_reports = [report for report in reports['Result'] if 'ai_element_performance' in report['ReportScheduleName'].lower()]
+        element_performance_reports = get_element_performance_reports(reports)
         
         if element_performance_reports:
             # Sort by LastStateChangeUTC to get the most recent report
             most_recent_report = sorted(element_performance_reports, key=lambda x: x['LastStateChangeUTC'], reverse=True)[0]
             
             # Prepare filename for download
-            report_name = most_recent_report['ReportScheduleName'].replace(' ', '_')
-            report_date = most_recent_report['ReportEndDateExclusive'].split('T')[0]
-            filename = os.path.join(DOWNLOAD_DIR, f"{report_name}_{report_date}.csv")
+            filename = report_filename(most_recent_report)
             
             # Ensure the download directory exists
             os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -117,6 +296,9 @@ if __name__ == "__main__":
                 download_url = most_recent_report['ReportDeliveries'][0]['DownloadURL']
                 if download_report(download_url, filename):
                     print(f"Report '{most_recent_report['ReportScheduleName']}' downloaded as '{filename}'")
+                    manifest = load_manifest()
+                    record_download(manifest, most_recent_report, filename)
+                    save_manifest(manifest)
                 else:
                     print("Failed to download the report.")
             else:
@@ -124,4 +306,21 @@ if __name__ == "__main__":
         else:
             print("No 'ai_element_performance' reports found.")
     else:
-        print("No reports found or error in retrieving reports.")
\ No newline at end of file
+        print("No reports found or error in retrieving reports.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download TTD ai_element_performance reports.")
+    parser.add_argument('--backfill', action='store_true', help="Download every missing report in the window instead of only the most recent one")
+    parser.add_argument('--days', type=int, default=BACKFILL_DAYS, help="Backfill window in days")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="Parallel downloads during backfill")
+    args = parser.parse_args()
+
+    if args.backfill:
+        failed = backfill_reports(args.days, args.workers)
+    else:
+        failed = None
+        download_most_recent_report()
+
+    get_client().log_stats()
+    if failed:
+        sys.exit(1)
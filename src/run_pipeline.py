@@ -4,6 +4,7 @@ import os
 import sqlite3
 from datetime import datetime
 import json
+from pinecone_jsonl import read_manifest
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -47,7 +48,15 @@ def check_row_count_change(db_path, table_name, before_count, tolerance_percent,
     if abs(percent_change) > tolerance_percent:
         raise Exception(f"{operation_name}: {table_name} row count change ({percent_change:.2f}%) exceeds tolerance of {tolerance_percent}%")
 
+def check_jsonl_exists(file_path):
+    """Like check_file_exists, but a sharded JSONL only has its manifest and shards on disk."""
+    if read_manifest(file_path) is None:
+        check_file_exists(file_path)
+
 def count_jsonl_rows(file_path):
+    manifest = read_manifest(file_path)
+    if manifest is not None:
+        return manifest['records']
     if not os.path.exists(file_path):
         return 0
     with open(file_path, 'r') as f:
@@ -98,7 +107,7 @@ def run_pipeline():
         # Step 6: Prepare Pinecone JSONL
         pinecone_data_before = count_jsonl_rows(jsonl_path)
         run_script('prepare_pinecone_jsonl.py')
-        check_file_exists(jsonl_path)
+        check_jsonl_exists(jsonl_path)
         check_jsonl_row_count_change(jsonl_path, pinecone_data_before, 10, 'Prepare Pinecone JSONL')
 
         # Step 7: Detect Pinecone changes
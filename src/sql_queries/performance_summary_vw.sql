@@ -1,13 +1,30 @@
-CREATE VIEW performance_summary AS
-SELECT 
-    CAST("3rd Party Data ID" AS INTEGER) || '|' || "3rd Party Data Brand ID" AS ThirdPartyDataId,
-    "Vertical",
-    SUM("Hypothetical Advertiser Cost (USD)") AS total_hypothetical_cost,
-    SUM("Clicks") AS total_clicks,
-    SUM("Impressions") AS total_impressions,
-    SUM("01 - Total Click + View Conversions") AS total_click_view_conversions
-FROM 
-    report_stack
-GROUP BY 
-    ThirdPartyDataId,
-    Vertical;
\ No newline at end of file
+-- performance_summary is a table maintained by concatenate_ttd_reports.py. Only keys whose
+-- report_stack rows were added or evicted in a run are re-aggregated. It replaces the
+-- performance_summary view of the same name, which is dropped first.
+
+CREATE TABLE IF NOT EXISTS performance_summary (
+    ThirdPartyDataId TEXT NOT NULL,
+    Vertical TEXT,
+    total_hypothetical_cost REAL,
+    total_clicks INTEGER,
+    total_impressions INTEGER,
+    total_click_view_conversions REAL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_performance_summary_key
+    ON performance_summary (ThirdPartyDataId, Vertical);
+
+-- ensure_summary_table also indexes the report table on the ThirdPartyDataId expression below,
+-- so key lookups on it use the index.
+
+-- Aggregation used to (re)build rows, optionally restricted to the keys in temp.touched_keys:
+-- SELECT
+--     CAST("3rd Party Data ID" AS INTEGER) || '|' || "3rd Party Data Brand ID" AS ThirdPartyDataId,
+--     "Vertical",
+--     SUM("Hypothetical Advertiser Cost (USD)") AS total_hypothetical_cost,
+--     SUM("Clicks") AS total_clicks,
+--     SUM("Impressions") AS total_impressions,
+--     SUM("01 - Total Click + View Conversions") AS total_click_view_conversions
+-- FROM report_stack
+-- WHERE ThirdPartyDataId IS NOT NULL  -- Rows with a blank data or brand ID have no key
+-- GROUP BY ThirdPartyDataId, Vertical;
@@ -0,0 +1,191 @@
+import json
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from dotenv import load_dotenv
+
+##############################################################################################
+# Shared client for The Trade Desk API used by every pipeline step.
+# One pooled keep-alive session per process, an auth token cached on disk so consecutive
+# steps reuse it until it expires, uniform retry/backoff, and request/byte counters.
+##############################################################################################
+
+# Load environment variables
+load_dotenv('/Users/adamhunter/miniconda3/envs/ragdev/ragdev.env')
+
+TTD_USERNAME = os.getenv('TTD_USERNAME')
+TTD_PASS = os.getenv('TTD_PASS')
+# Overridable so the pipeline can be pointed at a local fake TTD endpoint
+TTD_API_BASE = os.getenv('TTD_API_BASE', 'https://api.thetradedesk.com/v3')
+TOKEN_CACHE_PATH = os.getenv('TTD_TOKEN_CACHE', '/Users/adamhunter/Documents/3rd_party_element_pipeline/data/ttd_token.json')
+TOKEN_LIFETIME_MINUTES = 24 * 60
+TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+POOL_SIZE = 32
+
+
+class TTDClient:
+    """Pooled, retrying HTTP client for The Trade Desk API."""
+
+    def __init__(self, base_url: str = TTD_API_BASE, token_cache_path: str = TOKEN_CACHE_PATH,
+                 pool_size: int = POOL_SIZE, max_retries: int = 3, retry_delay: float = 5):
+        self.base_url = base_url.rstrip('/')
+        self.token_cache_path = token_cache_path
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self._token = None
+        self._token_expires = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "bytes_sent": 0, "bytes_received": 0, "token_requests": 0}
+
+    def url(self, path: str) -> str:
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    # Authentication
+
+    def get_token(self, force_refresh: bool = False) -> str:
+        """Return a valid auth token, from memory, the on-disk cache, or a new login."""
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            if not force_refresh:
+                if self._token and self._token_expires - TOKEN_REFRESH_MARGIN > now:
+                    return self._token
+                cached = self._read_token_cache()
+                if cached and cached[1] - TOKEN_REFRESH_MARGIN > now:
+                    self._token, self._token_expires = cached
+                    return self._token
+
+            payload = {"Login": TTD_USERNAME, "Password": TTD_PASS, "TokenExpirationInMinutes": TOKEN_LIFETIME_MINUTES}
+            response = self._send('POST', self.url('authentication'), json=payload, headers={})
+            with self._stats_lock:
+                self.stats["token_requests"] += 1
+            self._token = response.json().get("Token")
+            self._token_expires = now + timedelta(minutes=TOKEN_LIFETIME_MINUTES)
+            self._write_token_cache()
+            return self._token
+
+    def _read_token_cache(self):
+        try:
+            with open(self.token_cache_path, 'r') as f:
+                cached = json.load(f)
+            if cached.get("BaseUrl") != self.base_url:
+                return None
+            return cached["Token"], datetime.fromisoformat(cached["ExpiresUTC"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_token_cache(self):
+        os.makedirs(os.path.dirname(self.token_cache_path) or '.', exist_ok=True)
+        tmp_path = f"{self.token_cache_path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"Token": self._token, "ExpiresUTC": self._token_expires.isoformat(), "BaseUrl": self.base_url}, f)
+        os.replace(tmp_path, self.token_cache_path)
+
+    # Requests
+
+    def request(self, method: str, path: str, auth: bool = True, limiter=None,
+                on_throttle: Optional[Callable[[], None]] = None, **kwargs) -> requests.Response:
+        """Send a request with retries, backoff and Retry-After handling.
+
+        `limiter` is any object with `acquire()` and `pause(seconds)`, shared between
+        threads to keep the overall request rate down.
+        """
+        url = self.url(path)
+        kwargs.setdefault('timeout', 600)
+        refreshed = False
+        retry_delay = self.retry_delay
+
+        for attempt in range(self.max_retries):
+            try:
+                if limiter:
+                    limiter.acquire()
+                headers = dict(kwargs.pop('headers', {}) or {})
+                if auth:
+                    headers["TTD-Auth"] = self.get_token()
+                kwargs['headers'] = headers
+                return self._send(method, url, **kwargs)
+            except RequestException as e:
+                response = e.response  # _send raises before the response is returned
+                if (response is not None and response.status_code == 401 and auth and not refreshed
+                        and attempt < self.max_retries - 1):
+                    # Cached token was revoked or expired early
+                    self.get_token(force_refresh=True)
+                    refreshed = True
+                    continue
+                if response is not None and 400 <= response.status_code < 500 and response.status_code != 429:
+                    raise  # Client errors will not succeed on retry
+                if attempt == self.max_retries - 1:
+                    logging.error(f"{method} {url} failed after {self.max_retries} attempts: {e}")
+                    raise
+                delay = retry_delay
+                if response is not None and response.status_code == 429:  # Too Many Requests
+                    delay = int(response.headers.get('Retry-After', retry_delay))
+                    if limiter:
+                        limiter.pause(delay)
+                    if on_throttle:
+                        on_throttle()
+                else:
+                    retry_delay *= 2
+                with self._stats_lock:
+                    self.stats["retries"] += 1
+                logging.warning(f"{method} {url} failed. Retrying in {delay} seconds...")
+                time.sleep(delay)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        response = self.session.request(method, url, **kwargs)
+        self._count(response, stream=kwargs.get('stream', False))
+        response.raise_for_status()
+        return response
+
+    def _count(self, response: requests.Response, stream: bool = False):
+        body = response.request.body
+        sent = len(body) if body else 0
+        received = 0 if stream else len(response.content)
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_sent"] += sent
+            self.stats["bytes_received"] += received
+
+    def count_received(self, num_bytes: int):
+        """Account for bytes read from a streamed response."""
+        with self._stats_lock:
+            self.stats["bytes_received"] += num_bytes
+
+    def log_stats(self):
+        s = self.stats
+        logging.info(f"TTD API: {s['requests']} requests ({s['retries']} retries, {s['token_requests']} logins), "
+                     f"{s['bytes_sent']:,} bytes sent, {s['bytes_received']:,} bytes received")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> TTDClient:
+    """Return the process-wide client so every caller shares one connection pool."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:  # Another thread may have created it while we waited
+                _client = TTDClient()
+    return _client
@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+
+import pytest
+import requests
+
+# Pipeline modules import each other by bare name, as when run from src/
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+import ttd_client
+from ttd_client import TTDClient
+
+
+def make_response(status_code, headers=None, url='https://ttd.test/v3/thing'):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = b''
+    response.url = url
+    response.request = requests.Request('GET', url).prepare()
+    return response
+
+
+def serve(monkeypatch, client, responses):
+    """Answer the client's requests with `responses` in order, recording the auth headers sent."""
+    sent = []
+
+    def request(method, url, **kwargs):
+        sent.append(kwargs['headers'].get('TTD-Auth'))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client.session, 'request', request)
+    return sent
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A TTDClient with a fake token, recording sleeps instead of sleeping."""
+    client = TTDClient(base_url='https://ttd.test/v3', token_cache_path=str(tmp_path / 'token.json'), retry_delay=5)
+    client.token_refreshes = 0
+
+    def get_token(force_refresh=False):
+        if force_refresh:
+            client.token_refreshes += 1
+        return f"token-{client.token_refreshes}"
+
+    monkeypatch.setattr(client, 'get_token', get_token)
+    client.sleeps = []
+    monkeypatch.setattr(ttd_client.time, 'sleep', client.sleeps.append)
+    return client
@@ -0,0 +1,72 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from concatenate_ttd_reports import convert_to_columnar, get_report_hash, hash_file, iter_report_chunks, process_csv_files
+
+HEADER = ('Advertiser,3rd Party Data ID,3rd Party Data Brand ID,Hypothetical Advertiser Cost (USD),'
+          'Clicks,Impressions,01 - Total Click + View Conversions\n')
+
+
+def write_report(folder, days_ago, rows):
+    end = (datetime.now() - timedelta(days=days_ago)).date()
+    path = folder / f"ai_element_performance_{end}_from_{end - timedelta(days=7)}.csv"
+    path.write_text(HEADER + ''.join(f"{row}\n" for row in rows))
+    return str(path)
+
+
+def summary(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT ThirdPartyDataId, Vertical, total_clicks FROM performance_summary ORDER BY 1").fetchall()
+    conn.close()
+    return rows
+
+
+def test_blank_ids_are_left_out_of_the_summary(tmp_path):
+    db_path = str(tmp_path / 'perf.db')
+    conn = sqlite3.connect(db_path)
+    pd.DataFrame({'Advertiser': ['Acme'], 'Vertical': ['Auto']}).to_sql('advertiser_vertical_lookup', conn, index=False)
+    conn.close()
+    manifest_path = str(tmp_path / 'manifest.json')
+
+    first = write_report(tmp_path, 10, ['Acme,1,b1,1.5,2,10,0', 'Acme,,b1,1.0,5,10,0', 'Acme,2,,1.0,7,10,0'])
+    process_csv_files([first], db_path, 'report_stack', manifest_path=manifest_path)
+    assert summary(db_path) == [('1|b1', 'Auto', 2)]
+
+    # The incremental refresh of touched keys skips them as well
+    second = write_report(tmp_path, 3, ['Acme,1,b1,1.0,3,10,0', 'Acme,,,1.0,1,10,0'])
+    process_csv_files([first, second], db_path, 'report_stack', manifest_path=manifest_path)
+    assert summary(db_path) == [('1|b1', 'Auto', 5)]
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM report_stack").fetchone()[0] == 5
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'report_stack'")}
+    conn.close()
+    assert 'idx_report_stack_ThirdPartyDataId' in indexes
+
+
+def test_convert_to_columnar_streams_and_matches_the_csv(tmp_path):
+    extra = [f"Extra {n}" for n in range(3)]
+    lines = [HEADER.rstrip('\n') + ',' + ','.join(extra)]
+    for n in range(5000):
+        data_id = '' if n % 97 == 0 else str(n)
+        lines.append(f'"Acme, Inc",{data_id},b{n % 7},{n / 3},{n % 5},{n},{n / 10},x{n},{n},"a ""quoted"" {n}"')
+    csv_path = tmp_path / 'ai_element_performance_2024-01-08_from_2024-01-01.csv'
+    csv_path.write_text('\n'.join(lines) + '\n')
+    expected = pd.concat(iter_report_chunks(str(csv_path), 1000), ignore_index=True)
+    expected_all = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    source_hash = hash_file(str(csv_path))
+
+    # A zero memory limit falls back to the smallest chunks, so several are written
+    parquet_path = convert_to_columnar(str(csv_path), str(tmp_path / 'pq'), memory_limit_mb=0)
+
+    assert not csv_path.exists()
+    assert get_report_hash(parquet_path) == source_hash
+    assert pq.ParquetFile(parquet_path).metadata.num_row_groups > 1
+    actual = pd.concat(iter_report_chunks(parquet_path, 1000), ignore_index=True)
+    pd.testing.assert_frame_equal(actual, expected)
+    archived = pq.read_table(parquet_path).to_pandas()
+    assert list(archived.columns) == list(expected_all.columns)
+    assert archived[extra].values.tolist() == expected_all[extra].values.tolist()
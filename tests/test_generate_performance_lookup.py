@@ -0,0 +1,45 @@
+import pandas as pd
+
+from generate_performance_lookup import MatchIndex, create_vertical_mapping
+
+
+def lookup(companies):
+    return pd.DataFrame({
+        'Company Name': [name for name, _ in companies],
+        'Quickbooks Customer Name': [None] * len(companies),
+        'Client Group': [None] * len(companies),
+        'Client Industry Value': [vertical for _, vertical in companies],
+    })
+
+
+class FakeCategorizer:
+    def __init__(self, match):
+        self.match = match
+        self.asked = []
+
+    async def choose_matches(self, candidates):
+        self.asked.extend(candidates)
+        return {advertiser: self.match for advertiser in candidates}
+
+    async def categorize(self, advertisers, categories):
+        return {}
+
+    def log_stats(self):
+        pass
+
+
+def test_normalized_names_with_conflicting_verticals_are_ambiguous():
+    index = MatchIndex(lookup([('Acme Inc', 'Retail'), ('Acme LLC', 'Travel'), ('Globex Corp', 'Auto'), ('Globex', 'Auto')]))
+    assert index.resolve_normalized('ACME') is None
+    assert index.resolve_normalized('Globex Corporation') == ('Auto', 'Globex Corp')
+
+
+def test_conflicting_normalized_name_goes_to_the_llm():
+    categorizer = FakeCategorizer('Acme LLC')
+    df = create_vertical_mapping(['ACME', 'Globex Corporation'], lookup([('Acme Inc', 'Retail'), ('Acme LLC', 'Travel'), ('Globex Corp', 'Auto')]),
+                                 categorizer=categorizer)
+    rows = df.set_index('Advertiser')
+    assert categorizer.asked == ['ACME']
+    assert rows.loc['ACME', 'Vertical'] == 'Travel'
+    assert rows.loc['ACME', 'Categorization_Technique'] == 'Matched'
+    assert rows.loc['Globex Corporation', 'Categorization_Technique'] == 'Normalized Match'
@@ -0,0 +1,18 @@
+import asyncio
+import logging
+
+from llm_categorizer import LLMCategorizer
+
+
+class UnusedClient:
+    """Fails the test if the categorizer calls the model."""
+
+    def __getattr__(self, name):
+        raise AssertionError("the model should not be called")
+
+
+def test_no_categories_leaves_advertisers_uncategorized(caplog):
+    categorizer = LLMCategorizer(client=UnusedClient())
+    with caplog.at_level(logging.ERROR):
+        assert asyncio.run(categorizer.categorize(['Acme', 'Globex'], [])) == {}
+    assert 'Acme' in caplog.text and 'Globex' in caplog.text
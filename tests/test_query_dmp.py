@@ -0,0 +1,32 @@
+import json
+import threading
+
+import query_dmp
+
+
+def test_each_batch_prefetches_pages_ahead(tmp_path, monkeypatch):
+    page_size = 1000
+    total = 4500
+    lock = threading.Lock()
+    in_flight = {}
+    peak = {}
+    both_started = threading.Barrier(2, timeout=5)
+
+    def fetch_page(advertiser_id, batch, page_start_index, size, limiter, limits):
+        with lock:
+            in_flight[batch.batch_number] = in_flight.get(batch.batch_number, 0) + 1
+            peak[batch.batch_number] = max(peak.get(batch.batch_number, 0), in_flight[batch.batch_number])
+        if page_start_index < 2 * page_size:
+            both_started.wait()  # The first two pages only return once both are in flight
+        with lock:
+            in_flight[batch.batch_number] -= 1
+        return [{'Index': i} for i in range(page_start_index, min(page_start_index + size, total))]
+
+    monkeypatch.setattr(query_dmp, '_fetch_page', fetch_page)
+    output_file = tmp_path / 'dmp.jsonl'
+    written = query_dmp.fetch_all_third_party_data('adv', [['b1']], str(output_file), max_workers=8,
+                                                   requests_per_second=1000, pages_ahead=2)
+
+    assert written == total
+    assert peak == {1: 2}
+    assert sorted(json.loads(line)['Index'] for line in output_file.read_text().splitlines()) == list(range(total))
@@ -0,0 +1,27 @@
+import json
+import logging
+
+import retrieve_ttd_report
+from conftest import make_response, serve
+
+
+def test_416_on_complete_part_file_finishes_without_retrying(client, monkeypatch, tmp_path, caplog):
+    filename = str(tmp_path / 'report.csv')
+    with open(f"{filename}.part", 'w') as f:
+        f.write("a,b\n1,2\n")
+    with open(f"{filename}.part.json", 'w') as f:
+        json.dump({"ETag": '"v1"', "ContentEncoding": None}, f)
+    sent = serve(monkeypatch, client, [make_response(416)])
+    monkeypatch.setattr(retrieve_ttd_report, 'get_client', lambda: client)
+
+    with caplog.at_level(logging.WARNING):
+        assert retrieve_ttd_report.download_report('https://ttd.test/report', filename)
+
+    assert len(sent) == 1
+    assert client.sleeps == []
+    assert client.stats['retries'] == 0
+    assert not caplog.records
+    with open(filename) as f:
+        assert f.read() == "a,b\n1,2\n"
+    assert not (tmp_path / 'report.csv.part').exists()
+    assert not (tmp_path / 'report.csv.part.json').exists()
@@ -0,0 +1,67 @@
+import pytest
+import requests
+
+from conftest import make_response, serve
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.paused = []
+
+    def acquire(self):
+        pass
+
+    def pause(self, seconds):
+        self.paused.append(seconds)
+
+
+def test_401_refreshes_token_once_and_retries(client, monkeypatch):
+    sent = serve(monkeypatch, client, [make_response(401), make_response(200)])
+    assert client.get('thing').status_code == 200
+    assert client.token_refreshes == 1
+    assert sent == ['token-0', 'token-1']
+    assert client.sleeps == []
+
+
+def test_401_after_refresh_raises(client, monkeypatch):
+    serve(monkeypatch, client, [make_response(401), make_response(401)])
+    with pytest.raises(requests.HTTPError) as error:
+        client.get('thing')
+    assert error.value.response.status_code == 401
+    assert client.token_refreshes == 1
+
+
+def test_401_on_last_attempt_raises(client, monkeypatch):
+    client.max_retries = 1
+    serve(monkeypatch, client, [make_response(401)])
+    with pytest.raises(requests.HTTPError):
+        client.get('thing')
+    assert client.token_refreshes == 0
+
+
+def test_429_honours_retry_after_and_throttles(client, monkeypatch):
+    serve(monkeypatch, client, [make_response(429, {'Retry-After': '7'}), make_response(200)])
+    limiter = FakeLimiter()
+    throttled = []
+    assert client.get('thing', limiter=limiter, on_throttle=lambda: throttled.append(True)).status_code == 200
+    assert client.sleeps == [7]
+    assert limiter.paused == [7]
+    assert throttled == [True]
+    assert client.stats['retries'] == 1
+
+
+@pytest.mark.parametrize('status_code', [400, 404, 416])
+def test_client_errors_are_not_retried(client, monkeypatch, status_code):
+    serve(monkeypatch, client, [make_response(status_code)])
+    with pytest.raises(requests.HTTPError) as error:
+        client.get('thing')
+    assert error.value.response.status_code == status_code
+    assert client.sleeps == []
+    assert client.stats['retries'] == 0
+
+
+def test_server_errors_back_off_then_raise(client, monkeypatch):
+    serve(monkeypatch, client, [make_response(503) for _ in range(3)])
+    with pytest.raises(requests.HTTPError):
+        client.get('thing')
+    assert client.sleeps == [5, 10]